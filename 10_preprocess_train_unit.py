@@ -21,7 +21,7 @@ def preprocess(path, sample_rate, hop_size, encoder, encoder_sample_rate, encode
             audio_t = torch.from_numpy(audio).float().to(device)
             audio_t = audio_t.unsqueeze(0)
 
-            units_t = units_encoder.encode(audio_t, sample_rate, hop_size)
+            units_t = units_encoder.encode(audio_t, sample_rate)
             units = units_t.squeeze().to('cpu').numpy()
 
             os.makedirs(os.path.dirname(path_unitsfile), exist_ok=True)
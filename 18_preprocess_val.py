@@ -45,7 +45,7 @@ def preprocess(path, volume_extractor, mel_extractor, units_encoder, text2semant
         aug_mel = aug_mel_t.squeeze().to('cpu').numpy()
         aug_vol = volume_extractor.extract(audio * (10 ** log10_vol_shift), sr=sample_rate)
 
-        units_t = units_encoder.encode(audio_t, sample_rate, hop_size)
+        units_t = units_encoder.encode(audio_t, sample_rate)
         units = units_t.squeeze().to('cpu').numpy()
 
         speaker = binfile.split('\\')[0]
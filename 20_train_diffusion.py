@@ -3,7 +3,8 @@ import torch
 from tools import utils
 from diffusion.data_loaders import get_data_loaders
 from diffusion.solver import train
-from diffusion.unit2mel import Unit2Mel
+from diffusion.unit2mel import Unit2Mel, load_svc_model
+from diffusion.lora_adapter import add_lora
 from diffusion.vocoder import Vocoder
 import accelerate
 import itertools
@@ -15,6 +16,8 @@ from tools.tools import get_encdoer_out_channels
 def parse_args(args=None, namespace=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, default="configs/config.yaml")
+    parser.add_argument("-t", "--teacher", type=str, default=None, help="teacher checkpoint, enables progressive distillation")
+    parser.add_argument("-l", "--lora_base", type=str, default=None, help="base checkpoint, trains a LoRA speaker adapter on top of it")
     return parser.parse_args(args=args, namespace=namespace)
 
 if __name__ == '__main__':
@@ -36,9 +39,29 @@ if __name__ == '__main__':
         args['diffusion']['model']['block_out_channels'],
         args['diffusion']['model']['n_heads'],
         args['diffusion']['model']['n_hidden'],
-        args['data']['acoustic_scale']
+        args['data']['acoustic_scale'],
+        naive_n_layers=args['diffusion']['model'].get('naive_n_layers', 0),
+        naive_n_chans=args['diffusion']['model']['n_chans']
         )
 
+    teacher = None
+    if cmd.teacher is not None:
+        teacher = load_svc_model(args=args, vocoder_dimension=vocoder.dimension)
+        teacher.load_state_dict(torch.load(cmd.teacher, map_location='cpu')['model'])
+        teacher.requires_grad_(False)
+        teacher.eval()
+        # the distilled checkpoint samples with its own step grid
+        args['common']['infer']['method'] = 'distilled'
+        args['common']['infer']['speedup'] = teacher.decoder.k_step // args['diffusion']['distill']['end_steps']
+
+    lora = cmd.lora_base is not None
+    if lora:
+        # the base stays frozen, only the attention LoRA branches train and get saved
+        model.load_state_dict(torch.load(cmd.lora_base, map_location='cpu')['model'])
+        add_lora(model.decoder.denoise_fn, rank=args['diffusion']['lora']['rank'], network_alpha=args['diffusion']['lora'].get('network_alpha'))
+        for name, param in model.named_parameters():
+            param.requires_grad_('_lora.' in name)
+
     if args['text2semantic']['train']['use_units_quantize']:
         if args['text2semantic']['train']['units_quantize_type'] == "kmeans":
             from quantize.kmeans_codebook import EuclideanCodebook
@@ -57,12 +80,14 @@ if __name__ == '__main__':
         else:
             raise ValueError('[Error] Unknown quantize_type: ' + args['text2semantic']['train']['units_quantize_type'])
         
-        optimizer = torch.optim.AdamW(itertools.chain(model.parameters(),quantizer.parameters()))
+        optimizer = torch.optim.AdamW(itertools.chain(filter(lambda p: p.requires_grad, model.parameters()),quantizer.parameters()))
     else:
         quantizer = None
-        optimizer = torch.optim.AdamW(model.parameters())
+        optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()))
     
     initial_global_step, model, optimizer = utils.load_model(args['diffusion']['train']['expdir'], model, optimizer, device=args['common']['device'])
+    if teacher is not None and initial_global_step == 0:
+        model.load_state_dict(teacher.state_dict())
 
     if quantizer is not None and args['text2semantic']['train']['units_quantize_type'] == "vq":
         try:
@@ -82,6 +107,8 @@ if __name__ == '__main__':
         warm_up_steps=args['diffusion']['train']['warm_up_steps'],
         start_lr=float(args['diffusion']['train']['start_lr']))
     model.to(device)
+    if teacher is not None:
+        teacher.to(device)
     
     for state in optimizer.state.values():
         for k, v in state.items():
@@ -90,4 +117,4 @@ if __name__ == '__main__':
                     
     loader_train, loader_valid = get_data_loaders(args, whole_audio=False,accelerator=accelerator)
     _, model, quantizer, optim, scheduler = accelerator.prepare(loader_train, model, quantizer, optimizer, scheduler)
-    train(args, initial_global_step, model, optimizer, scheduler, vocoder, loader_train, loader_valid, quantizer, accelerator)
\ No newline at end of file
+    train(args, initial_global_step, model, optimizer, scheduler, vocoder, loader_train, loader_valid, quantizer, accelerator, teacher=teacher, lora=lora)
\ No newline at end of file
@@ -27,7 +27,8 @@ if __name__ == '__main__':
     
     model = get_model(args['common']['n_spk'], **args['text2semantic'])
     
-    if accelerator.is_main_process:
+    # with async_val the validation worker loads its own diffusion model
+    if accelerator.is_main_process and not args['text2semantic']['train'].get('async_val', False):
         diffusion_model = DiffusionSVC(device=device)
         diffusion_model.load_model(model_path=cmd.model, f0_max=1200, f0_min=40)
     else:
@@ -57,4 +58,4 @@ if __name__ == '__main__':
     loader_train, loader_valid = get_data_loaders(args,model = model, accelerate=accelerator)
     _, model, optimizer, scheduler = accelerator.prepare(loader_train, model, optimizer, scheduler)
 
-    train(args, initial_global_step, model, optimizer, scheduler, diffusion_model, loader_train, loader_valid, accelerator)
\ No newline at end of file
+    train(args, initial_global_step, model, optimizer, scheduler, diffusion_model, loader_train, loader_valid, accelerator, diffusion_model_path=cmd.model)
\ No newline at end of file
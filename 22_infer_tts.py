@@ -12,6 +12,8 @@ import soundfile as sf
 import numpy as np
 from vector_quantize_pytorch import VectorQuantize
 from tools.tools import get_encdoer_out_channels
+from tools.quantization import load_int8
+from diffusion.diffusion import SamplerTrace
 
 def parse_args(args=None, namespace=None):
     parser = argparse.ArgumentParser()
@@ -20,8 +22,19 @@ def parse_args(args=None, namespace=None):
     parser.add_argument("-i",  "--input",           type=str, default="你说的对，但是原神是由米哈游自主研发的一款全新开放世界冒险游戏。")
     parser.add_argument("-d" , "--device",          type=str, default=None)
     parser.add_argument("-o",  "--output",          type=str, default='1.wav')
-    parser.add_argument("-s",  "--speedup",         type=str, default=10)
-    parser.add_argument("-me", "--method",          type=str, default='dpm-solver')
+    parser.add_argument("-sid", "--spk_id",         type=int, default=1)
+    parser.add_argument("-s",  "--speedup",         type=int, default=10)
+    parser.add_argument("-me", "--method",          type=str, default='dpm-solver', help="dpm-solver, dpm-solver-adaptive, unipc, pndm, ddim or distilled")
+    parser.add_argument("-atol", "--atol",          type=float, default=0.0078, help="dpm-solver-adaptive absolute tolerance")
+    parser.add_argument("-rtol", "--rtol",          type=float, default=0.05, help="dpm-solver-adaptive relative tolerance")
+    parser.add_argument("-cs", "--chunk_size",      type=int, default=None)
+    parser.add_argument("-co", "--chunk_overlap",   type=int, default=64)
+    parser.add_argument("-k",  "--k_step",          type=int, default=None)
+    parser.add_argument("-p",  "--precision",       type=str, default=None, choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument("-b",  "--backend",         type=str, default=None, choices=['torch', 'onnx'], help='onnx expects the output of 23_export_onnx.py in <model dir>/onnx')
+    parser.add_argument("-q",  "--int8",            action='store_true', default=None, help='int8 cpu inference, quantized weights are cached next to each checkpoint')
+    parser.add_argument("-qc", "--int8_convs",      action='store_true', default=None, help='with int8, also int8 conv weights in the UNet and the vocoder (saves memory, runs slower)')
+    parser.add_argument("-cp", "--check_precision", type=str, default=None, choices=['fp16', 'bf16'], help='print the latent and waveform error of this precision against fp32 before inferring')
     return parser.parse_args(args=args, namespace=namespace)
 
 if __name__ == '__main__':
@@ -33,7 +46,7 @@ if __name__ == '__main__':
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
         diffusion_svc = DiffusionSVC(device=device)
-        diffusion_svc.load_model(model_path=cmd.diffusion_model, f0_max=800, f0_min=65)
+        diffusion_svc.load_model(model_path=cmd.diffusion_model, precision=cmd.precision, int8=cmd.int8, int8_convs=cmd.int8_convs, backend=cmd.backend)
         config_file = os.path.join(os.path.split(cmd.language_model)[0], 'config.yaml')
         with open(config_file, "r") as config:
             args = yaml.safe_load(config)
@@ -66,8 +79,13 @@ if __name__ == '__main__':
         else:
             raise ValueError(' [x] Unknown quantize_type: ' + args['text2semantic']['train']['units_quantize_type'])
 
-        lm = get_language_model(**args).to(device)
-        lm.load_state_dict(torch.load(cmd.language_model, map_location=torch.device(device))["model"])
+        int8 = diffusion_svc.args['common']['infer'].get('int8', False) if cmd.int8 is None else cmd.int8
+        lm = get_language_model(**args)
+        if int8:
+            load_int8(lm, cmd.language_model, lambda m: m.load_state_dict(torch.load(cmd.language_model, map_location='cpu')["model"]))
+        else:
+            lm.load_state_dict(torch.load(cmd.language_model, map_location=torch.device(device))["model"])
+        lm = lm.to(device)
         lm.eval()
 
         text = cmd.input
@@ -109,6 +127,14 @@ if __name__ == '__main__':
             semantic_emb = units_forced_alignment(semantic_emb,
                                                   scale_factor=(diffusion_svc.args['data']['sampling_rate']/diffusion_svc.args['data']['block_size'])/(diffusion_svc.args.data.encoder_sample_rate/args.data.encoder_hop_size))
 
-        wav = diffusion_svc.infer(semantic_emb,f0=None,volume=None, spk_id = spk_id, infer_speedup=speedup, method=method)
+        if cmd.check_precision is not None:
+            errors = diffusion_svc.check_precision(semantic_emb, None, None, precision=cmd.check_precision, spk_id=spk_id, infer_speedup=speedup, method=method)
+            print(f' [*] {cmd.check_precision} vs fp32:', ', '.join(f'{k}={v:.3e}' for k, v in errors.items()))
+
+        # the adaptive solver picks its own number of steps, the trace counts them for this call only
+        instrument = SamplerTrace() if method == 'dpm-solver-adaptive' else None
+        wav = diffusion_svc.infer(semantic_emb,f0=None,volume=None, spk_id = spk_id, infer_speedup=speedup, method=method, chunk_size=cmd.chunk_size, chunk_overlap=cmd.chunk_overlap, k_step=cmd.k_step, instrument=instrument, atol=cmd.atol, rtol=cmd.rtol)
+        if instrument is not None:
+            print(' [*] dpm-solver-adaptive nfe:', instrument.nfe)
         
         sf.write(cmd.output, wav.detach().cpu().numpy()[0,0], diffusion_svc.args['data']['sampling_rate'])
\ No newline at end of file
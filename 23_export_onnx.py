@@ -0,0 +1,28 @@
+import os
+import argparse
+from diffusion.unit2mel import load_model_vocoder
+from tools.onnx_tools import export_denoiser, export_generator
+
+def parse_args(args=None, namespace=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model",  type=str, default="exp/diffusion/model_380000.pt")
+    parser.add_argument("-o", "--output", type=str, default=None, help="defaults to <model dir>/onnx")
+    parser.add_argument("--opset",        type=int, default=17)
+    return parser.parse_args(args=args, namespace=namespace)
+
+if __name__ == '__main__':
+    cmd = parse_args()
+    output = cmd.output
+    if output is None:
+        output = os.path.join(os.path.split(cmd.model)[0], 'onnx')
+    os.makedirs(output, exist_ok=True)
+
+    model, vocoder, args = load_model_vocoder(cmd.model, device='cpu', precision='fp32', int8=False)
+
+    denoise_fn = model.decoder.denoise_fn
+    export_denoiser(denoise_fn, os.path.join(output, 'denoiser.onnx'), denoise_fn.conv_in.in_channels, opset=cmd.opset)
+    print(' [*] Exported denoiser to', os.path.join(output, 'denoiser.onnx'))
+
+    generator = vocoder.vocoder.load_decoder()
+    export_generator(generator, os.path.join(output, 'generator.onnx'), vocoder.dimension, opset=cmd.opset)
+    print(' [*] Exported generator to', os.path.join(output, 'generator.onnx'))
@@ -0,0 +1,108 @@
+import os
+import copy
+import json
+import yaml
+import argparse
+import itertools
+import torch
+import accelerate
+from tools.utils import DotDict
+from tools.tools import StepLRWithWarmUp
+from diffusion.data_loaders import get_data_loaders
+from diffusion.solver import train
+from diffusion.unit2mel import load_model_vocoder, load_svc_model
+from diffusion.pruning import collect_importance, child_block_out_channels, width_index_sets, channel_dims, slice_state_dict, param_count, head_report, compare
+
+def parse_args(args=None, namespace=None):
+    parser = argparse.ArgumentParser(description='prune the diffusion UNet to a narrower child and distill it from the parent')
+    parser.add_argument("-m", "--model",      type=str, required=True, help="parent checkpoint")
+    parser.add_argument("-r", "--keep_ratio", type=float, default=0.75, help="fraction of channels kept per level")
+    parser.add_argument("-o", "--output",     type=str, required=True, help="expdir of the child")
+    parser.add_argument("--calib_batches",    type=int, default=16)
+    parser.add_argument("--finetune",         action='store_true', help="fine-tune the child through solver.train with the parent as teacher")
+    parser.add_argument("--method",           type=str, default='dpm-solver', help="sampler for the report")
+    parser.add_argument("--speedup",          type=int, default=10, help="speedup for the report")
+    return parser.parse_args(args=args, namespace=namespace)
+
+def get_kmeans_quantizer(args, device):
+    # the parent sees quantized units if it was trained on them; a vq codebook is trained jointly and not reloaded here
+    if not args['text2semantic']['train']['use_units_quantize'] or args['text2semantic']['train']['units_quantize_type'] != 'kmeans':
+        return None
+    from quantize.kmeans_codebook import EuclideanCodebook
+    from cluster import get_cluster_model
+    codebook_weight = get_cluster_model(args['text2semantic']['model']['codebook_path']).__dict__["cluster_centers_"]
+    return EuclideanCodebook(codebook_weight).to(device)
+
+def calibration_batches(loader, quantizer, device, n_batches):
+    for data in itertools.islice(loader, n_batches):
+        for k in data.keys():
+            if type(data[k]) is torch.Tensor:
+                data[k] = data[k].to(device)
+        if quantizer is not None:
+            data['units'] = quantizer(data['units']).detach()
+        yield data
+
+if __name__ == '__main__':
+    cmd = parse_args()
+    accelerator = accelerate.Accelerator()
+    device = accelerator.device
+
+    parent, vocoder, args = load_model_vocoder(cmd.model, device=device, precision='fp32', int8=False, tune_attention=False)
+    parent.decoder.set_length_buckets(None)
+    quantizer = get_kmeans_quantizer(args, device)
+    loader_train, loader_valid = get_data_loaders(args, whole_audio=False, accelerator=accelerator)
+
+    # score channels (and heads) of the parent on a calibration set
+    parent.eval()
+    channels, heads = collect_importance(parent, calibration_batches(loader_train, quantizer, device, cmd.calib_batches))
+    block_out_channels = list(args['diffusion']['model']['block_out_channels'])
+    child_channels = child_block_out_channels(block_out_channels, cmd.keep_ratio, args['diffusion']['model']['n_heads'])
+    index_sets = width_index_sets(channels, child_channels)
+    print(f' [*] block_out_channels: {block_out_channels} -> {child_channels}')
+
+    # child config and checkpoint, initialized from the kept parent channels
+    child_args = DotDict(copy.deepcopy(dict(args)))
+    child_args['diffusion']['model']['block_out_channels'] = child_channels
+    child_args['diffusion']['train']['expdir'] = cmd.output
+    child = load_svc_model(args=child_args, vocoder_dimension=vocoder.dimension)
+    dims = channel_dims(parent.decoder.denoise_fn, prefix='decoder.denoise_fn.')
+    child.load_state_dict(slice_state_dict(parent.state_dict(), child.state_dict(), dims, block_out_channels, index_sets))
+    child.to(device)
+    os.makedirs(cmd.output, exist_ok=True)
+    with open(os.path.join(cmd.output, 'config.yaml'), 'w') as out_config:
+        yaml.dump(dict(child_args), out_config)
+    torch.save({'global_step': 0, 'model': child.state_dict()}, os.path.join(cmd.output, 'model_0.pt'))
+
+    if cmd.finetune:
+        parent.requires_grad_(False)
+        optimizer = torch.optim.AdamW(child.parameters())
+        for param_group in optimizer.param_groups:
+            param_group['initial_lr'] = child_args['diffusion']['train']['lr']
+            param_group['lr'] = child_args['diffusion']['train']['lr']
+            param_group['weight_decay'] = child_args['diffusion']['train']['weight_decay']
+        scheduler = StepLRWithWarmUp(
+            optimizer,
+            step_size=child_args['diffusion']['train']['decay_step'],
+            gamma=child_args['diffusion']['train']['gamma'],
+            last_epoch=-2,
+            warm_up_steps=child_args['diffusion']['train']['warm_up_steps'],
+            start_lr=float(child_args['diffusion']['train']['start_lr']))
+        _, child, optimizer, scheduler = accelerator.prepare(loader_train, child, optimizer, scheduler)
+        try:
+            train(child_args, 0, child, optimizer, scheduler, vocoder, loader_train, loader_valid, quantizer, accelerator, teacher=parent, distill='width')
+        except KeyboardInterrupt:
+            print(' [*] Fine-tuning stopped')
+        child = accelerator.unwrap_model(child)
+
+    # latency and quality of the child against the parent
+    child.eval()
+    report = {
+        'parent': cmd.model,
+        'block_out_channels': {'parent': block_out_channels, 'child': child_channels},
+        'params': {'parent': param_count(parent), 'child': param_count(child)},
+        'heads': head_report(heads),
+        'results': compare(parent, child, args['diffusion']['model']['n_hidden'], device, method=cmd.method, infer_speedup=cmd.speedup),
+    }
+    with open(os.path.join(cmd.output, 'prune_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(' [*] Saved report to', os.path.join(cmd.output, 'prune_report.json'))
@@ -0,0 +1,16 @@
+import argparse
+from tools import utils
+from encoder.hifi_vaegan.hifi_vaegan import export_fused
+
+def parse_args(args=None, namespace=None):
+    parser = argparse.ArgumentParser(description='fold weight norm into the vaegan weights and write config.json, loaded automatically afterwards')
+    parser.add_argument("-c", "--config", type=str, default="configs/config.yaml")
+    parser.add_argument("-m", "--model",  type=str, default=None, help="vaegan checkpoint dir, defaults to common.vocoder.ckpt of the config")
+    return parser.parse_args(args=args, namespace=namespace)
+
+if __name__ == '__main__':
+    cmd = parse_args()
+    model_path = cmd.model
+    if model_path is None:
+        model_path = utils.load_config(cmd.config)['common']['vocoder']['ckpt']
+    export_fused(model_path)
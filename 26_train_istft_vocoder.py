@@ -0,0 +1,20 @@
+import argparse
+import accelerate
+from rich.console import Console
+from tools import utils
+from encoder.hifi_vaegan.istft_train import get_data_loader, train
+
+def parse_args(args=None, namespace=None):
+    parser = argparse.ArgumentParser(description='train an istft-head decoder on the latent of an existing hifi-vaegan')
+    parser.add_argument("-c", "--config", type=str, default="configs/config.yaml")
+    return parser.parse_args(args=args, namespace=namespace)
+
+if __name__ == '__main__':
+    cmd = parse_args()
+    accelerator = accelerate.Accelerator()
+    args = utils.load_config(cmd.config)
+    print('Training Args: ')
+    Console().print(args['istft_vocoder'])
+
+    loader_train = get_data_loader(args)
+    train(args, accelerator, loader_train)
@@ -2,7 +2,7 @@ import os
 import argparse
 import torch
 from tools import utils
-from batch_proccessor.dataloader import get_data_loaders, lenth_to_mask
+from batch_proccessor.dataloader import get_data_loaders
 from tools.tools import Units_Encoder
 import accelerate
 import itertools
@@ -66,16 +66,13 @@ if __name__ == '__main__':
                 for i in range(len(audios)):
                     audios[i] = resample_kernel(torch.from_numpy(audios[i]).to(device)).cpu().numpy()
             audio_lenth = audio_lenth * resample_scale_factor
-        padding_mask = lenth_to_mask(audio_lenth)
-        semantic = units_encoder.encode(audios, int(args.data.encoder_sample_rate), args.data.encoder_hop_size, padding_mask)
+        semantic, unit_lenth = units_encoder.encode_batch(audios, audio_lenth, int(args.data.encoder_sample_rate))
 
         if args.data.force_units_interpolation:
             units_t = torch.nn.functional.interpolate(units_t.transpose(-1,-2), scale_factor=args.data.encoder_hop_size/args.data.source_encoder_hop_size, mode='linear', align_corners=False).transpose(-1,-2)
 
-        audio_lenth = audio_lenth.cpu().numpy()
-        ac_len = np.ceil(audio_lenth / args.data.encoder_hop_size)
         with ThreadPoolExecutor(max_workers=10) as executor:
-            executor.map(save_semantic, semantic, ac_len, itertools.repeat(train_path_meldir), names)
+            executor.map(save_semantic, semantic, unit_lenth.numpy(), itertools.repeat(train_path_meldir), names)
 
     valid_path_meldir = os.path.join(args.data.valid_path, 'units')
 
@@ -89,13 +86,10 @@ if __name__ == '__main__':
                 for i in range(len(audios)):
                     audios[i] = resample_kernel(torch.from_numpy(audios[i]).to(device)).cpu().numpy()
             audio_lenth = audio_lenth * resample_scale_factor
-        padding_mask = lenth_to_mask(audio_lenth)
-        semantic = units_encoder.encode(audios, int(args.data.encoder_sample_rate), args.data.encoder_hop_size, padding_mask)
+        semantic, unit_lenth = units_encoder.encode_batch(audios, audio_lenth, int(args.data.encoder_sample_rate))
 
         if args.data.force_units_interpolation:
             units_t = torch.nn.functional.interpolate(units_t.transpose(-1,-2), scale_factor=args.data.encoder_hop_size/args.data.source_encoder_hop_size, mode='linear', align_corners=False).transpose(-1,-2)
 
-        audio_lenth = audio_lenth.cpu().numpy()
-        ac_len = np.ceil(audio_lenth / args.data.encoder_hop_size)
         with ThreadPoolExecutor(max_workers=10) as executor:
-            executor.map(save_semantic, semantic, ac_len, itertools.repeat(valid_path_meldir), names)
\ No newline at end of file
+            executor.map(save_semantic, semantic, unit_lenth.numpy(), itertools.repeat(valid_path_meldir), names)
\ No newline at end of file
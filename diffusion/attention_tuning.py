@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import hashlib
+import platform
+import torch
+import torch.nn.functional as F
+from .unet1d import attention_processor
+from .unet1d.attention_processor import AttnProcessor, AttnProcessor2_0, SlicedAttnProcessor, XFormersAttnProcessor
+
+TUNE_LENGTHS = (256, 1024, 4096)
+
+def xformers_available():
+    try:
+        import xformers.ops
+    except ImportError:
+        return False
+    attention_processor.xformers = xformers
+    return True
+
+def candidate_processors(device):
+    candidates = {'classic': AttnProcessor, 'sliced': lambda: SlicedAttnProcessor(slice_size=4)}
+    if hasattr(F, "scaled_dot_product_attention"):
+        candidates['sdpa'] = AttnProcessor2_0
+    if torch.device(device).type == 'cuda' and xformers_available():
+        candidates['xformers'] = XFormersAttnProcessor
+    return candidates
+
+def device_name(device):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return platform.processor() or platform.machine()
+
+def tuning_key(device, model_config, out_dims):
+    config = json.dumps({'model': model_config, 'out_dims': out_dims}, sort_keys=True)
+    return '|'.join((device_name(device), torch.__version__, hashlib.sha1(config.encode()).hexdigest()[:16]))
+
+@torch.no_grad()
+def time_denoiser(diffusion, n_frames, device, repeats=3):
+    n_in = diffusion.denoise_fn.conv_in.in_channels
+    x = torch.randn(1, 1, diffusion.out_dims, n_frames, device=device)
+    cond = torch.randn(1, n_in - diffusion.out_dims, n_frames, device=device)
+    t = torch.full((1,), diffusion.k_step // 2, device=device, dtype=torch.long)
+    denoise = diffusion.get_denoiser(x, cond)
+    denoise(x, t)  # warmup
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        denoise(x, t)
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+def select_attention_processor(diffusion, device, model_config, cache_path, lengths=TUNE_LENGTHS):
+    # times every available processor on the denoiser at a few lengths, installs the fastest
+    # and remembers it per (device, torch version, model config) in cache_path.
+    # if none of them runs, the processors the model had are kept and nothing is cached
+    key = tuning_key(device, model_config, diffusion.out_dims)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    candidates = candidate_processors(device)
+    if key in cache and cache[key]['processor'] in candidates:
+        best = cache[key]['processor']
+    else:
+        original = diffusion.denoise_fn.attn_processors
+        timings = {}
+        for name, processor in candidates.items():
+            diffusion.denoise_fn.set_attn_processor(processor())
+            try:
+                timings[name] = sum(time_denoiser(diffusion, n, device) for n in lengths)
+            except (RuntimeError, NotImplementedError) as e:
+                print(f' [!] attention processor {name} failed: {e}')
+        if len(timings) == 0:
+            diffusion.denoise_fn.set_attn_processor(original)
+            print(' [!] No attention processor could be timed, keeping the current one')
+            return None
+        best = min(timings, key=timings.get)
+        cache[key] = {'processor': best, 'timings': timings, 'lengths': list(lengths)}
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+    diffusion.denoise_fn.set_attn_processor(candidates[best]())
+    print(f' [*] Attention processor: {best}')
+    return best
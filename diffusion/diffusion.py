@@ -1,4 +1,5 @@
-from collections import deque
+import json
+import time
 from functools import partial
 from inspect import isfunction
 import torch.nn.functional as F
@@ -20,6 +21,146 @@ def extract(a, t, x_shape):
     out = a.gather(-1, t)
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
+def denoise_input_buffer(x, cond, n_frames=None):
+    # [B, M + H, T] buffer whose cond part is written once, spec part is refreshed per step.
+    # with n_frames > T the tail stays zero (length bucketing)
+    b, _, m, n = x.shape
+    if n_frames is None or n_frames == n:
+        buffer = cond.new_empty((b, m + cond.shape[1], n))
+    else:
+        buffer = cond.new_zeros((b, m + cond.shape[1], n_frames))
+    buffer[:, m:, :n].copy_(cond)
+    spec = buffer[:, :m, :n]
+    def fill(x):
+        spec.copy_(x[:, 0, :, :])
+        return buffer
+    return fill
+
+class ChunkedDenoiser:
+    # runs the denoiser on overlapping windows along T and crossfades the predictions,
+    # so attention memory is bounded by chunk_size instead of the utterance length
+    def __init__(self, n_frames, chunk_size, overlap, device):
+        assert 0 <= overlap < chunk_size
+        self.chunk_size = chunk_size
+        self.starts = list(range(0, n_frames - chunk_size, chunk_size - overlap)) + [n_frames - chunk_size]
+        ramp = torch.linspace(0, 1, overlap + 2, device=device)[1:-1]
+        weights = []
+        norm = torch.zeros(n_frames, device=device)
+        for i, start in enumerate(self.starts):
+            weight = torch.ones(chunk_size, device=device)
+            if overlap > 0 and i > 0:
+                weight[:overlap] = ramp
+            if overlap > 0 and i < len(self.starts) - 1:
+                weight[-overlap:] = ramp.flip(0)
+            norm[start: start + chunk_size] += weight
+            weights.append(weight)
+        self.weights = [weight / norm[start: start + chunk_size] for weight, start in zip(weights, self.starts)]
+
+    def __call__(self, denoise_fn, denoise_input, t):
+        b, _, n = denoise_input.shape
+        out = None
+        for start, weight in zip(self.starts, self.weights):
+            noise_pred = denoise_fn(denoise_input[:, :, start: start + self.chunk_size], t).sample
+            if out is None:
+                out = noise_pred.new_zeros((b, noise_pred.shape[1], n), dtype=torch.float32)
+            out[:, :, start: start + self.chunk_size].addcmul_(noise_pred, weight)
+        return out
+
+class DeepCacheDenoiser:
+    # full UNet every `interval` evaluations, in between only the shallowest `depth` levels run
+    # on top of the deep feature of the last full evaluation
+    def __init__(self, interval, depth):
+        self.interval = interval
+        self.depth = depth
+        self.cache = {}
+        self.calls = 0
+
+    def __call__(self, denoise_fn, denoise_input, t):
+        refresh = self.calls % self.interval == 0
+        self.calls += 1
+        return denoise_fn.forward_cached(denoise_input, t, self.cache, cache_depth=self.depth, refresh=refresh)
+
+class SamplerTrace:
+    # opt-in instrumentation, pass forward(..., instrument=SamplerTrace()) to get one
+    # structured event per denoiser evaluation plus start / end events
+    def __init__(self, record_norms=False):
+        self.record_norms = record_norms
+        self.events = []
+        self.nfe = 0
+        self._start = None
+
+    def start(self, method, steps, x):
+        self._start = time.perf_counter()
+        self.events.append({'event': 'start', 'method': method, 'steps': steps, 'batch': x.shape[0], 'n_frames': x.shape[-1]})
+
+    def denoise(self, t, x, noise_pred, wall_time):
+        event = {'event': 'denoise', 'index': self.nfe, 't': float(t.reshape(-1)[0]), 'n_frames': x.shape[-1], 'wall_time': wall_time}
+        if self.record_norms:
+            event['x_norm'] = x.norm().item()
+            event['noise_norm'] = noise_pred.norm().item()
+        self.events.append(event)
+        self.nfe += 1
+
+    def end(self):
+        self.events.append({'event': 'end', 'nfe': self.nfe, 'wall_time': time.perf_counter() - self._start})
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event) + '\n')
+
+def synchronize(x):
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+
+class SamplerContext:
+    # per-call sampler state (progress bar, instrument), kept off the module so one
+    # GaussianDiffusion can serve concurrent requests
+    def __init__(self, use_tqdm=False, instrument=None):
+        self.use_tqdm = use_tqdm
+        self.instrument = instrument
+        self.bar = None
+
+    def start(self, method, steps, x, progress_bar=False):
+        # the pndm / ddim / distilled loops draw their own bar over steps
+        if self.use_tqdm and progress_bar:
+            self.bar = tqdm(desc="sample time step", total=steps)
+        if self.instrument is not None:
+            self.instrument.start(method, steps, x)
+
+    def timed(self, fn):
+        # reports every denoiser evaluation to the instrument, fn is returned as is without one
+        if self.instrument is None:
+            return fn
+        def timed_fn(x, t):
+            synchronize(x)
+            start = time.perf_counter()
+            ret = fn(x, t)
+            synchronize(ret)
+            self.instrument.denoise(t, x, ret, time.perf_counter() - start)
+            return ret
+        return timed_fn
+
+    def wrap(self, fn):
+        # model_fn(x, t, cond) for the dpm-solver / unipc model wrappers
+        def wrapped(x, t, cond, **kwargs):
+            ret = fn(x, t)
+            if self.bar is not None:
+                self.bar.update(1)
+            return ret
+        return wrapped
+
+    def close(self):
+        if self.bar is not None:
+            self.bar.close()
+            self.bar = None
+        if self.instrument is not None:
+            self.instrument.end()
+
+def bucket_denoise(denoise_fn, denoise_input, t):
+    # takes the module as an argument so copies of a model never call back into the original
+    return denoise_fn(denoise_input, t).sample
+
 def noise_like(shape, device, repeat=False):
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
     noise = lambda: torch.randn(shape, device=device)
@@ -57,8 +198,6 @@ class GaussianDiffusion(nn.Module):
         self.num_timesteps = int(timesteps)
         self.k_step = k_step
 
-        self.noise_list = deque(maxlen=4)
-
         to_torch = partial(torch.tensor, dtype=torch.float32)
 
         self.register_buffer('betas', to_torch(betas))
@@ -85,6 +224,12 @@ class GaussianDiffusion(nn.Module):
         self.register_buffer('spec_max', torch.FloatTensor([spec_max])[None, None, :out_dims])
         self.norm_spec = lambda x: x * acoustic_scale
         self.denorm_spec = lambda x: x / acoustic_scale
+        self.autocast_dtype = None
+        self.length_buckets = None
+        self.bucket_denoise_fn = None
+        self.bucket_max_batch_size = None
+        self.cache_interval = None
+        self.cache_depth = 1
 
     def q_mean_variance(self, x_start, t):
         mean = extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
@@ -101,9 +246,12 @@ class GaussianDiffusion(nn.Module):
         posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
-    def p_mean_variance(self, x, t, cond):
-        denoise_input = torch.cat([x[:,0,:,:], cond], dim=-2)
-        noise_pred = self.denoise_fn(denoise_input, t).sample[:,None,:,:]
+    def p_mean_variance(self, x, t, cond, denoise=None):
+        if denoise is None:
+            denoise_input = torch.cat([x[:,0,:,:], cond], dim=-2)
+            noise_pred = self.denoise_fn(denoise_input, t).sample[:,None,:,:]
+        else:
+            noise_pred = denoise(x, t)
         x_recon = self.predict_start_from_noise(x, t=t, noise=noise_pred)
 
         x_recon.clamp_(-1., 1.)
@@ -112,59 +260,157 @@ class GaussianDiffusion(nn.Module):
         return model_mean, posterior_variance, posterior_log_variance
 
     @torch.no_grad()
-    def p_sample(self, x, t, cond, clip_denoised=True, repeat_noise=False):
+    def p_sample(self, x, t, cond, clip_denoised=True, repeat_noise=False, denoise=None):
         b, *_, device = *x.shape, x.device
-        model_mean, _, model_log_variance = self.p_mean_variance(x=x, t=t, cond=cond)
+        model_mean, _, model_log_variance = self.p_mean_variance(x=x, t=t, cond=cond, denoise=denoise)
         noise = noise_like(x.shape, device, repeat_noise)
         # no noise when t == 0
         nonzero_mask = (1 - (t == 0).float()).reshape(b, *((1,) * (len(x.shape) - 1)))
         return model_mean + nonzero_mask * (0.5 * model_log_variance).exp() * noise
     
+    def get_denoiser(self, x, cond, chunk_size=None, chunk_overlap=64):
+        # returns eps(x, t) -> [B, 1, M, T], optionally evaluated chunk by chunk along T
+        n_frames = x.shape[-1]
+        bucket = self.get_length_bucket(n_frames) if chunk_size is None else None
+        if self.cache_interval is not None and chunk_size is None:
+            # a fresh cache per sampling call, the bucketed graphs are bypassed
+            denoise_input = denoise_input_buffer(x, cond)
+            cached = DeepCacheDenoiser(self.cache_interval, self.cache_depth)
+            eps = lambda x, t: cached(self.denoise_fn, denoise_input(x), t)[:,None,:,:]
+        elif bucket is not None:
+            denoise_input = denoise_input_buffer(x, cond, bucket)
+            bucket_fn = self.bucket_denoise_fn if x.shape[0] <= self.bucket_max_batch_size else bucket_denoise
+            eps = lambda x, t: bucket_fn(self.denoise_fn, denoise_input(x), t)[:,None,:,:n_frames]
+        elif chunk_size is None or n_frames <= chunk_size:
+            denoise_input = denoise_input_buffer(x, cond)
+            eps = lambda x, t: self.denoise_fn(denoise_input(x), t).sample[:,None,:,:]
+        else:
+            denoise_input = denoise_input_buffer(x, cond)
+            chunker = ChunkedDenoiser(n_frames, chunk_size, chunk_overlap, x.device)
+            eps = lambda x, t: chunker(self.denoise_fn, denoise_input(x), t)[:,None,:,:]
+        if self.autocast_dtype is None:
+            return eps
+
+        # only the UNet runs under autocast (GroupNorm is kept in fp32 by the autocast policy),
+        # the solver coefficients and updates see an fp32 prediction
+        def eps_autocast(x, t):
+            with torch.autocast(x.device.type, dtype=self.autocast_dtype):
+                noise_pred = eps(x, t)
+            return noise_pred.float()
+        return eps_autocast
+
+    def set_length_buckets(self, buckets, compile=True, max_batch_size=8):
+        # pads T up to the smallest bucket that fits and crops afterwards, so the UNet only
+        # ever sees a few static lengths; buckets are rounded up to multiples of the upsampling
+        # factor to avoid the interpolation path. longer inputs run unpadded.
+        # this is not exact: the zero padded tail is visible to attention and enters the GroupNorm
+        # statistics of every resnet, which shifts the valid frames as well. the error grows with the
+        # padded fraction, so keep the buckets reasonably dense (tools/sampler_benchmark.py
+        # --length_buckets reports it against the unpadded path).
+        if not buckets:
+            self.length_buckets = None
+            self.bucket_denoise_fn = None
+            return
+        factor = 2 ** self.denoise_fn.num_upsamplers
+        self.length_buckets = sorted(set(-(-b // factor) * factor for b in buckets))
+        self.bucket_max_batch_size = max_batch_size
+        if not compile:
+            self.bucket_denoise_fn = bucket_denoise
+            return
+        # one static graph per (bucket, batch size): dynamo's recompile limit has to cover all of them,
+        # or it falls back to eager without a word. batches above max_batch_size run the bucket eagerly
+        import torch._dynamo
+        n_graphs = len(self.length_buckets) * max_batch_size
+        dynamo_config = torch._dynamo.config
+        dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, n_graphs)
+        if hasattr(dynamo_config, 'accumulated_cache_size_limit'):
+            dynamo_config.accumulated_cache_size_limit = max(dynamo_config.accumulated_cache_size_limit, n_graphs)
+        self.bucket_denoise_fn = torch.compile(bucket_denoise, dynamic=False)
+
+    def set_deep_cache(self, interval, depth=1):
+        # reuses the deep down / mid / up features for `interval - 1` denoiser calls after every
+        # full one; works with every sampler and needs no retraining, at some cost in quality
+        if not interval or interval <= 1:
+            self.cache_interval = None
+            return
+        self.cache_interval = interval
+        self.cache_depth = depth
+
+    def get_length_bucket(self, n_frames):
+        if self.length_buckets is None:
+            return None
+        return next((b for b in self.length_buckets if b >= n_frames), None)
+
+    def alphas_cumprod_at(self, t):
+        # index -1 is the clean end of the chain
+        return torch.where(t < 0, torch.ones_like(t, dtype=self.alphas_cumprod.dtype), self.alphas_cumprod[t.clamp(min=0)])
+
+    def distill_timesteps(self, steps, t_max, device):
+        # uniform grid of `steps` student steps over [0, t_max), -1 is the clean end
+        return torch.round(torch.arange(steps + 1, device=device) * t_max / steps).long() - 1
+
+    def ddim_step(self, x, noise_pred, a_t, a_prev):
+        x_start = (x - (1 - a_t).sqrt() * noise_pred) / a_t.sqrt()
+        return a_prev.sqrt() * x_start + (1 - a_prev).sqrt() * noise_pred
+
+    def ddim_coefficients(self, timesteps, interval):
+        a_t = self.alphas_cumprod[timesteps][:, None, None, None]
+        a_prev = self.alphas_cumprod[torch.clamp(timesteps - interval, min=0)][:, None, None, None]
+        return a_t.sqrt(), a_prev.sqrt(), ((1 - a_prev) / a_prev).sqrt() - ((1 - a_t) / a_t).sqrt()
+
+    def plms_coefficients(self, timesteps, interval):
+        a_t = self.alphas_cumprod[timesteps][:, None, None, None]
+        a_prev = self.alphas_cumprod[torch.clamp(timesteps - interval, min=0)][:, None, None, None]
+        a_t_sq, a_prev_sq = a_t.sqrt(), a_prev.sqrt()
+        coef_x = 1 / (a_t_sq * (a_t_sq + a_prev_sq))
+        coef_noise = 1 / (a_t_sq * (((1 - a_prev) * a_t).sqrt() + ((1 - a_t) * a_prev).sqrt()))
+        return a_prev - a_t, coef_x, coef_noise
+
     @torch.no_grad()
-    def p_sample_ddim(self, x, t, interval, cond):
-        a_t = extract(self.alphas_cumprod, t, x.shape)
-        a_prev = extract(self.alphas_cumprod, torch.max(t - interval, torch.zeros_like(t)), x.shape)
-        
-        denoise_input = torch.cat([x[:,0,:,:], cond], dim=-2)
-        noise_pred = self.denoise_fn(denoise_input, t).sample[:,None,:,:]
-        x_prev = a_prev.sqrt() * (x / a_t.sqrt() + (((1 - a_prev) / a_prev).sqrt()-((1 - a_t) / a_t).sqrt()) * noise_pred)
-        return x_prev
-        
-    @torch.no_grad()
-    def p_sample_plms(self, x, t, interval, cond, clip_denoised=True, repeat_noise=False):
-        def get_x_pred(x, noise_t, t):
-            a_t = extract(self.alphas_cumprod, t, x.shape)
-            a_prev = extract(self.alphas_cumprod, torch.max(t - interval, torch.zeros_like(t)), x.shape)
-            a_t_sq, a_prev_sq = a_t.sqrt(), a_prev.sqrt()
+    def p_sample_ddim(self, x, t, coef, denoise, tmp):
+        # updates x in place: x_prev = sqrt(a_prev) * (x / sqrt(a_t) + coef * eps)
+        a_t_sq, a_prev_sq, coef_noise = coef
+        noise_pred = denoise(x, t)
+        x.div_(a_t_sq)
+        x.add_(torch.mul(coef_noise, noise_pred, out=tmp))
+        return x.mul_(a_prev_sq)
 
-            x_delta = (a_prev - a_t) * ((1 / (a_t_sq * (a_t_sq + a_prev_sq))) * x - 1 / (
-                    a_t_sq * (((1 - a_prev) * a_t).sqrt() + ((1 - a_t) * a_prev).sqrt())) * noise_t)
-            x_pred = x + x_delta
+    @torch.no_grad()
+    def p_sample_plms(self, x, t, t_prev, coef, denoise, noise_list, buffers):
+        # updates x in place, noise_list holds views into preallocated history slots
+        noise_prime, x_pred, tmp1, tmp2, free_slots = buffers
 
-            return x_pred
-        
-        denoise_input = torch.cat([x[:,0,:,:], cond], dim=-2)
+        def get_x_pred(x, noise_t, out):
+            coef_delta, coef_x, coef_noise = coef
+            torch.mul(coef_x, x, out=tmp1)
+            tmp1.sub_(torch.mul(coef_noise, noise_t, out=tmp2))
+            tmp1.mul_(coef_delta)
+            return torch.add(x, tmp1, out=out)
 
-        noise_list = self.noise_list
-        noise_pred = self.denoise_fn(denoise_input, t).sample[:,None,:,:]
+        noise_pred = denoise(x, t)
 
         if len(noise_list) == 0:
-            x_pred = get_x_pred(x, noise_pred, t)
-            
-            denoise_input = torch.cat([x_pred[:,0,:,:], cond], dim=-2)
-            noise_pred_prev = self.denoise_fn(denoise_input, max(t - interval, 0)).sample[:,None,:,:]
-            noise_pred_prime = (noise_pred + noise_pred_prev) / 2
+            get_x_pred(x, noise_pred, x_pred)
+            noise_pred_prev = denoise(x_pred, t_prev)
+            torch.add(noise_pred, noise_pred_prev, out=noise_prime).div_(2)
         elif len(noise_list) == 1:
-            noise_pred_prime = (3 * noise_pred - noise_list[-1]) / 2
+            torch.mul(noise_pred, 3, out=noise_prime)
+            noise_prime.sub_(noise_list[-1]).div_(2)
         elif len(noise_list) == 2:
-            noise_pred_prime = (23 * noise_pred - 16 * noise_list[-1] + 5 * noise_list[-2]) / 12
+            torch.mul(noise_pred, 23, out=noise_prime)
+            noise_prime.sub_(torch.mul(noise_list[-1], 16, out=tmp2))
+            noise_prime.add_(torch.mul(noise_list[-2], 5, out=tmp2)).div_(12)
         else:
-            noise_pred_prime = (55 * noise_pred - 59 * noise_list[-1] + 37 * noise_list[-2] - 9 * noise_list[-3]) / 24
+            torch.mul(noise_pred, 55, out=noise_prime)
+            noise_prime.sub_(torch.mul(noise_list[-1], 59, out=tmp2))
+            noise_prime.add_(torch.mul(noise_list[-2], 37, out=tmp2))
+            noise_prime.sub_(torch.mul(noise_list[-3], 9, out=tmp2)).div_(24)
 
-        x_prev = get_x_pred(x, noise_pred_prime, t)
-        noise_list.append(noise_pred)
+        get_x_pred(x, noise_prime, x)
+        slot = free_slots.pop() if len(free_slots) > 0 else noise_list.pop(0)
+        noise_list.append(slot.copy_(noise_pred))
 
-        return x_prev
+        return x
 
     def q_sample(self, x_start, t, noise=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
@@ -186,10 +432,48 @@ class GaussianDiffusion(nn.Module):
 
         return loss
 
-    def forward(self, condition, gt_spec=None, infer=True, infer_speedup=10, method='dpm-solver', k_step=None, use_tqdm=False):
+    def p_losses_distill(self, x_start, cond, teacher_fn, teacher_cond, steps):
+        # progressive distillation: one student step on the `steps` grid matches two teacher DDIM steps
+        b, device = x_start.shape[0], x_start.device
+        grid = self.distill_timesteps(2 * steps, self.k_step, device)
+        n = torch.randint(1, steps + 1, (b,), device=device)
+        t, t_mid, t_prev = grid[2 * n], grid[2 * n - 1], grid[2 * n - 2]
+        a_t, a_mid, a_prev = [self.alphas_cumprod_at(i)[:, None, None, None] for i in (t, t_mid, t_prev)]
+
+        x_t = a_t.sqrt() * x_start + (1 - a_t).sqrt() * torch.randn_like(x_start)
+        with torch.no_grad():
+            noise_pred = teacher_fn(torch.cat([x_t[:,0,:,:], teacher_cond], dim=-2), t).sample[:,None,:,:]
+            x_mid = self.ddim_step(x_t, noise_pred, a_t, a_mid)
+            noise_pred = teacher_fn(torch.cat([x_mid[:,0,:,:], teacher_cond], dim=-2), t_mid).sample[:,None,:,:]
+            x_prev = self.ddim_step(x_mid, noise_pred, a_mid, a_prev)
+            # the x_start for which a single DDIM step t -> t_prev lands on x_prev
+            ratio = ((1 - a_prev) / (1 - a_t)).sqrt()
+            x_start_target = (x_prev - ratio * x_t) / (a_prev.sqrt() - ratio * a_t.sqrt())
+            noise_target = (x_t - a_t.sqrt() * x_start_target) / (1 - a_t).sqrt()
+
+        noise_pred = self.denoise_fn(torch.cat([x_t[:,0,:,:], cond], dim=-2), t).sample[:,None,:,:]
+        return F.mse_loss(noise_pred, noise_target)
+
+    def p_losses_teacher(self, x_start, cond, teacher_fn, teacher_cond):
+        # width distillation: the usual noise target plus the teacher's prediction on the same noisy input
+        t = torch.randint(0, self.k_step, (x_start.shape[0],), device=x_start.device).long()
+        noise = torch.randn_like(x_start)
+        x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
+        with torch.no_grad():
+            teacher_pred = teacher_fn(torch.cat([x_noisy[:,0,:,:], teacher_cond], dim=-2), t).sample[:,None,:,:]
+        noise_pred = self.denoise_fn(torch.cat([x_noisy[:,0,:,:], cond], dim=-2), t).sample[:,None,:,:]
+        return F.mse_loss(noise_pred, noise) + F.mse_loss(noise_pred, teacher_pred)
+
+    def forward(self, condition, gt_spec=None, infer=True, infer_speedup=10, method='dpm-solver', k_step=None, use_tqdm=False, chunk_size=None, chunk_overlap=64, teacher_fn=None, teacher_condition=None, distill_steps=None, instrument=None, atol=0.0078, rtol=0.05):
         cond = condition.transpose(1, 2)
         b, device = condition.shape[0], condition.device
 
+        if not infer and teacher_fn is not None:
+            norm_spec = self.norm_spec(gt_spec).transpose(1, 2)[:, None, :, :]  # [B, 1, M, T]
+            if distill_steps is None:
+                return self.p_losses_teacher(norm_spec, cond, teacher_fn, teacher_condition.transpose(1, 2))
+            return self.p_losses_distill(norm_spec, cond, teacher_fn, teacher_condition.transpose(1, 2), distill_steps)
+
         if not infer:
             spec = self.norm_spec(gt_spec)
             if k_step is None:
@@ -210,135 +494,136 @@ class GaussianDiffusion(nn.Module):
                 norm_spec = self.norm_spec(gt_spec)
                 norm_spec = norm_spec.transpose(1, 2)[:, None, :, :]
                 x = self.q_sample(x_start=norm_spec, t=torch.tensor([t - 1], device=device).long())
-                        
-            if method is not None and infer_speedup > 1:
-                if method == 'dpm-solver':
-                    from .dpm_solver_pytorch import NoiseScheduleVP, model_wrapper, DPM_Solver
-                    # 1. Define the noise schedule.
-                    noise_schedule = NoiseScheduleVP(schedule='discrete', betas=self.betas[:t])
-
-                    # 2. Convert your discrete-time `model` to the continuous-time
-                    # noise prediction model. Here is an example for a diffusion model
-                    # `model` with the noise prediction type ("noise") .
-                    def my_wrapper(fn):
-                        def wrapped(x, t, cond, **kwargs):
-                            denoise_input = torch.cat([x[:,0,:,:], cond], dim=-2)
-                            ret = fn(denoise_input, t, **kwargs).sample[:,None,:,:]
-                            if use_tqdm:
-                                self.bar.update(1)
-                            return ret
-                        return wrapped
-
-                    model_fn = model_wrapper(
-                        my_wrapper(self.denoise_fn),
-                        noise_schedule,
-                        model_type="noise",  # or "x_start" or "v" or "score"
-                        model_kwargs={"cond": cond}
-                    )
-
-                    # 3. Define dpm-solver and sample by singlestep DPM-Solver.
-                    # (We recommend singlestep DPM-Solver for unconditional sampling)
-                    # You can adjust the `steps` to balance the computation
-                    # costs and the sample quality.
-                    dpm_solver = DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++")
-
-                    steps = t // infer_speedup
-                    if use_tqdm:
-                        self.bar = tqdm(desc="sample time step", total=steps)
-                    
-                    x = dpm_solver.sample(
-                        x,
-                        steps=steps,
-                        order=2,
-                        skip_type="time_uniform",
-                        method="multistep"
-                    )
-                    if use_tqdm:
-                        self.bar.close()
-                elif method == 'unipc':
-                    from .uni_pc import NoiseScheduleVP, model_wrapper, UniPC
-                    # 1. Define the noise schedule.
-                    noise_schedule = NoiseScheduleVP(schedule='discrete', betas=self.betas[:t])
-
-                    # 2. Convert your discrete-time `model` to the continuous-time
-                    # noise prediction model. Here is an example for a diffusion model
-                    # `model` with the noise prediction type ("noise") .
-                    def my_wrapper(fn):
-                        def wrapped(x, t, cond, **kwargs):
-                            denoise_input = torch.cat([x[:,0,:,:], cond], dim=-2)
-                            ret = fn(denoise_input, t, **kwargs).sample[:,None,:,:]
-                            if use_tqdm:
-                                self.bar.update(1)
-                            return ret
-                        return wrapped
-
-                    model_fn = model_wrapper(
-                        my_wrapper(self.denoise_fn),
-                        noise_schedule,
-                        model_type="noise",  # or "x_start" or "v" or "score"
-                        model_kwargs={"cond": cond}
-                    )
-
-                    # 3. Define uni_pc and sample by multistep UniPC.
-                    # You can adjust the `steps` to balance the computation
-                    # costs and the sample quality.
-                    uni_pc = UniPC(model_fn, noise_schedule, variant='bh2')
-
-                    steps = t // infer_speedup
-                    if use_tqdm:
-                        self.bar = tqdm(desc="sample time step", total=steps)
-                    
-                    x = uni_pc.sample(
-                        x,
-                        steps=steps,
-                        order=2,
-                        skip_type="time_uniform",
-                        method="multistep",
-                    )
-                    if use_tqdm:
-                        self.bar.close()
-                elif method == 'pndm':
-                    self.noise_list = deque(maxlen=4)
-                    if use_tqdm:
-                        for i in tqdm(
-                                reversed(range(0, t, infer_speedup)), desc='sample time step',
-                                total=t // infer_speedup,
-                        ):
-                            x = self.p_sample_plms(
-                                x, torch.full((b,), i, device=device, dtype=torch.long),
-                                infer_speedup, cond=cond
+
+            ctx = SamplerContext(use_tqdm, instrument)
+            try:
+                # ddim at speedup 1 is the deterministic full-length reference, the adaptive solver ignores infer_speedup
+                if method is not None and (infer_speedup > 1 or method in ('ddim', 'dpm-solver-adaptive')):
+                    if method in ('dpm-solver', 'dpm-solver-adaptive'):
+                        from .dpm_solver_pytorch import NoiseScheduleVP, model_wrapper, DPM_Solver
+                        # 1. Define the noise schedule.
+                        noise_schedule = NoiseScheduleVP(schedule='discrete', betas=self.betas[:t])
+
+                        # 2. Convert your discrete-time `model` to the continuous-time
+                        # noise prediction model. Here is an example for a diffusion model
+                        # `model` with the noise prediction type ("noise") .
+                        denoise = ctx.timed(self.get_denoiser(x, cond, chunk_size, chunk_overlap))
+                        model_fn = model_wrapper(
+                            ctx.wrap(denoise),
+                            noise_schedule,
+                            model_type="noise",  # or "x_start" or "v" or "score"
+                            model_kwargs={"cond": cond}
+                        )
+
+                        # 3. Define dpm-solver and sample by singlestep DPM-Solver.
+                        # (We recommend singlestep DPM-Solver for unconditional sampling)
+                        # You can adjust the `steps` to balance the computation
+                        # costs and the sample quality.
+                        dpm_solver = DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++")
+
+                        if method == 'dpm-solver-adaptive':
+                            # step sizes follow the local error estimate (atol / rtol), the number of
+                            # denoiser calls is only known afterwards, pass an instrument (e.g. SamplerTrace) to read its nfe
+                            ctx.start(method, None, x, progress_bar=True)
+                            x = dpm_solver.sample(
+                                x,
+                                order=2,
+                                method="adaptive",
+                                atol=atol,
+                                rtol=rtol
                             )
-                    else:
-                        for i in reversed(range(0, t, infer_speedup)):
+                        else:
+                            steps = t // infer_speedup
+                            ctx.start(method, steps, x, progress_bar=True)
+                            x = dpm_solver.sample(
+                                x,
+                                steps=steps,
+                                order=2,
+                                skip_type="time_uniform",
+                                method="multistep"
+                            )
+                    elif method == 'unipc':
+                        from .uni_pc import NoiseScheduleVP, model_wrapper, UniPC
+                        # 1. Define the noise schedule.
+                        noise_schedule = NoiseScheduleVP(schedule='discrete', betas=self.betas[:t])
+
+                        # 2. Convert your discrete-time `model` to the continuous-time
+                        # noise prediction model. Here is an example for a diffusion model
+                        # `model` with the noise prediction type ("noise") .
+                        denoise = ctx.timed(self.get_denoiser(x, cond, chunk_size, chunk_overlap))
+                        model_fn = model_wrapper(
+                            ctx.wrap(denoise),
+                            noise_schedule,
+                            model_type="noise",  # or "x_start" or "v" or "score"
+                            model_kwargs={"cond": cond}
+                        )
+
+                        # 3. Define uni_pc and sample by multistep UniPC.
+                        # You can adjust the `steps` to balance the computation
+                        # costs and the sample quality.
+                        uni_pc = UniPC(model_fn, noise_schedule, variant='bh2')
+
+                        steps = t // infer_speedup
+                        ctx.start(method, steps, x, progress_bar=True)
+                        x = uni_pc.sample(
+                            x,
+                            steps=steps,
+                            order=2,
+                            skip_type="time_uniform",
+                            method="multistep",
+                        )
+                    elif method == 'pndm':
+                        timesteps = torch.arange(0, t, infer_speedup, device=device).flip(0)
+                        timesteps_prev = torch.clamp(timesteps - infer_speedup, min=0)
+                        coef_delta, coef_x, coef_noise = self.plms_coefficients(timesteps, infer_speedup)
+                        denoise = ctx.timed(self.get_denoiser(x, cond, chunk_size, chunk_overlap))
+                        buffers = (torch.empty_like(x), torch.empty_like(x), torch.empty_like(x), torch.empty_like(x), list(x.new_empty((3, *x.shape)).unbind(0)))
+                        noise_list = []
+                        ctx.start(method, len(timesteps), x)
+                        steps = range(len(timesteps))
+                        if use_tqdm:
+                            steps = tqdm(steps, desc='sample time step', total=len(timesteps))
+                        for i in steps:
                             x = self.p_sample_plms(
-                                x, torch.full((b,), i, device=device, dtype=torch.long),
-                                infer_speedup, cond=cond
+                                x, timesteps[i].expand(b), timesteps_prev[i].expand(b),
+                                (coef_delta[i], coef_x[i], coef_noise[i]), denoise, noise_list, buffers
                             )
-                elif method == 'ddim':
-                    if use_tqdm:
-                        for i in tqdm(
-                                reversed(range(0, t, infer_speedup)), desc='sample time step',
-                                total=t // infer_speedup,
-                        ):
+                    elif method == 'ddim':
+                        timesteps = torch.arange(0, t, infer_speedup, device=device).flip(0)
+                        a_t_sq, a_prev_sq, coef_noise = self.ddim_coefficients(timesteps, infer_speedup)
+                        denoise = ctx.timed(self.get_denoiser(x, cond, chunk_size, chunk_overlap))
+                        tmp = torch.empty_like(x)
+                        ctx.start(method, len(timesteps), x)
+                        steps = range(len(timesteps))
+                        if use_tqdm:
+                            steps = tqdm(steps, desc='sample time step', total=len(timesteps))
+                        for i in steps:
                             x = self.p_sample_ddim(
-                                x, torch.full((b,), i, device=device, dtype=torch.long),
-                                infer_speedup, cond=cond
+                                x, timesteps[i].expand(b), (a_t_sq[i], a_prev_sq[i], coef_noise[i]), denoise, tmp
                             )
+                    elif method == 'distilled':
+                        # deterministic steps on the grid the student was distilled for, ending at the clean sample
+                        timesteps = self.distill_timesteps(max(t // infer_speedup, 1), t, device)
+                        denoise = ctx.timed(self.get_denoiser(x, cond, chunk_size, chunk_overlap))
+                        ctx.start(method, len(timesteps) - 1, x)
+                        steps = reversed(range(1, len(timesteps)))
+                        if use_tqdm:
+                            steps = tqdm(steps, desc='sample time step', total=len(timesteps) - 1)
+                        for i in steps:
+                            a_t, a_prev = self.alphas_cumprod_at(timesteps[i - 1: i + 1]).flip(0)
+                            x = self.ddim_step(x, denoise(x, timesteps[i].expand(b)), a_t, a_prev)
                     else:
-                        for i in reversed(range(0, t, infer_speedup)):
-                            x = self.p_sample_ddim(
-                                x, torch.full((b,), i, device=device, dtype=torch.long),
-                                infer_speedup, cond=cond
-                            )
+                        raise NotImplementedError(method)
                 else:
-                    raise NotImplementedError(method)
-            else:
-                if use_tqdm:
-                    for i in tqdm(reversed(range(0, t)), desc='sample time step', total=t):
-                        x = self.p_sample(x, torch.full((b,), i, device=device, dtype=torch.long), cond)
-                else:
-                    for i in reversed(range(0, t)):
-                        x = self.p_sample(x, torch.full((b,), i, device=device, dtype=torch.long), cond)
+                    denoise = ctx.timed(self.get_denoiser(x, cond, chunk_size, chunk_overlap))
+                    ctx.start(None, t, x)
+                    steps = reversed(range(0, t))
+                    if use_tqdm:
+                        steps = tqdm(steps, desc='sample time step', total=t)
+                    for i in steps:
+                        x = self.p_sample(x, torch.full((b,), i, device=device, dtype=torch.long), cond, denoise=denoise)
+            finally:
+                ctx.close()
             x = x.squeeze(1).transpose(1, 2)  # [B, T, M]
             return self.denorm_spec(x)
 
@@ -1006,7 +1006,7 @@ class DPM_Solver:
                 lambda_s = ns.marginal_lambda(s)
             h = torch.min(theta * h * torch.float_power(E, -1. / order).float(), lambda_0 - lambda_s)
             nfe += order
-        print('adaptive solver nfe', nfe)
+        self.nfe = nfe
         return x
 
     def add_noise(self, x, t, noise=None):
@@ -1176,7 +1176,9 @@ class DPM_Solver:
                 step = 0
                 t = timesteps[step]
                 t_prev_list = [t]
-                model_prev_list = [self.model_fn(x, t)]
+                # The model history lives in preallocated slots, the list only rotates views into them.
+                model_prev_slots = x.new_empty((order, *x.shape)).unbind(0)
+                model_prev_list = [model_prev_slots[0].copy_(self.model_fn(x, t))]
                 if self.correcting_xt_fn is not None:
                     x = self.correcting_xt_fn(x, t, step)
                 if return_intermediate:
@@ -1190,7 +1192,7 @@ class DPM_Solver:
                     if return_intermediate:
                         intermediates.append(x)
                     t_prev_list.append(t)
-                    model_prev_list.append(self.model_fn(x, t))
+                    model_prev_list.append(model_prev_slots[step].copy_(self.model_fn(x, t)))
                 # Compute the remaining values by `order`-th order multistep DPM-Solver.
                 for step in range(order, steps + 1):
                     t = timesteps[step]
@@ -1206,11 +1208,11 @@ class DPM_Solver:
                         intermediates.append(x)
                     for i in range(order - 1):
                         t_prev_list[i] = t_prev_list[i + 1]
-                        model_prev_list[i] = model_prev_list[i + 1]
                     t_prev_list[-1] = t
+                    model_prev_list.append(model_prev_list.pop(0))
                     # We do not need to evaluate the final model value.
                     if step < steps:
-                        model_prev_list[-1] = self.model_fn(x, t)
+                        model_prev_list[-1].copy_(self.model_fn(x, t))
             elif method in ['singlestep', 'singlestep_fixed']:
                 if method == 'singlestep':
                     timesteps_outer, orders = self.get_orders_and_timesteps_for_singlestep_solver(steps=steps, order=order, skip_type=skip_type, t_T=t_T, t_0=t_0, device=device)
@@ -0,0 +1,110 @@
+import os
+from collections import OrderedDict
+import yaml
+import torch
+import torch.nn.functional as F
+from .unet1d.attention_processor import Attention, LoRAAttnProcessor, LoRAAttnProcessor2_0
+from tools.quantization import Int8Conv1d
+
+# LoRA branch of the attention processor -> linear layer of the Attention module it adapts
+LORA_TARGETS = {'to_q_lora': 'to_q', 'to_k_lora': 'to_k', 'to_v_lora': 'to_v', 'to_out_lora': 'to_out.0'}
+
+def add_lora(unet, rank=8, network_alpha=None):
+    # swaps every attention processor for its LoRA variant, the base linears stay untouched
+    processor_class = LoRAAttnProcessor2_0 if hasattr(F, "scaled_dot_product_attention") else LoRAAttnProcessor
+    processors = {}
+    for name, module in unet.named_modules():
+        if isinstance(module, Attention):
+            assert module.to_q.in_features == module.to_q.out_features
+            processors[f'{name}.processor'] = processor_class(
+                hidden_size=module.to_q.out_features,
+                cross_attention_dim=module.to_k.in_features,
+                rank=rank,
+                network_alpha=network_alpha)
+    unet.set_attn_processor(processors)
+
+def lora_state_dict(model):
+    return {k: v for k, v in model.state_dict().items() if '_lora.' in k}
+
+def load_lora_factors(path):
+    # {param name of the adapted linear weight: (down, up, scale)}, delta = scale * up @ down
+    config_file = os.path.join(os.path.split(path)[0], 'config.yaml')
+    network_alpha = None
+    if os.path.exists(config_file):
+        with open(config_file, "r") as config:
+            network_alpha = yaml.safe_load(config)['diffusion'].get('lora', {}).get('network_alpha')
+    state = torch.load(path, map_location='cpu')['model']
+    factors = {}
+    for key, down in state.items():
+        if not key.endswith('_lora.down.weight'):
+            continue
+        prefix = key[:-len('.down.weight')]
+        processor_path, lora_name = prefix.rsplit('.', 1)
+        attn_path = processor_path[:-len('.processor')]
+        up = state[prefix + '.up.weight']
+        scale = network_alpha / down.shape[0] if network_alpha is not None else 1.
+        factors[f'{attn_path}.{LORA_TARGETS[lora_name]}.weight'] = (down.float(), up.float(), scale)
+    return factors
+
+class LoraAdapterBank:
+    # one set of base weights for many voices: adapters stay low-rank until activated, then
+    # base + scale * up @ down is written into the attention linears. the `capacity` most recently
+    # used merged variants are kept, so switching back to them is a plain copy. merging only
+    # ever starts from the saved base weights, so repeated switches do not drift.
+    def __init__(self, model, capacity=8):
+        # int8 layers keep their weights as packed params / buffers, merging into them would silently do nothing
+        if any(isinstance(m, (torch.ao.nn.quantized.dynamic.Linear, Int8Conv1d)) for m in model.modules()):
+            raise ValueError(' [x] LoRA adapters need the float model, load it without int8 to use them')
+        self.params = dict(model.named_parameters())
+        self.capacity = capacity
+        self.adapters = {}
+        self.base = {}
+        self.merged = OrderedDict()
+        self.active = None
+
+    def add(self, name, path):
+        factors = load_lora_factors(path)
+        for key in factors:
+            if key not in self.params:
+                raise ValueError(f' [x] Adapter {path} does not match the model: {key}')
+            if key not in self.base:
+                self.base[key] = self.params[key].detach().clone()
+        self.adapters[name] = factors
+        self.merged.pop(name, None)
+        if self.active == name:
+            self.active = None
+            self.activate(name)
+
+    def remove(self, name):
+        if self.active == name:
+            self.activate(None)
+        self.adapters.pop(name)
+        self.merged.pop(name, None)
+
+    def merge(self, name):
+        weights = {}
+        for key, (down, up, scale) in self.adapters[name].items():
+            base = self.base[key]
+            weights[key] = torch.addmm(base, up.to(base), down.to(base), alpha=scale)
+        return weights
+
+    @torch.no_grad()
+    def activate(self, name):
+        if name == self.active:
+            return
+        if name is None:
+            weights = self.base
+        elif name not in self.adapters:
+            raise ValueError(f' [x] Unknown adapter: {name}')
+        elif name in self.merged:
+            weights = self.merged[name]
+            self.merged.move_to_end(name)
+        else:
+            weights = self.merge(name)
+            self.merged[name] = weights
+            while len(self.merged) > self.capacity:
+                self.merged.popitem(last=False)
+        # layers the previous adapter touched but this one does not go back to base
+        for key, base in self.base.items():
+            self.params[key].copy_(weights.get(key, base))
+        self.active = name
@@ -0,0 +1,203 @@
+import math
+import torch
+from tools.sampler_benchmark import run_sampler
+from .unet1d.attention_processor import Attention
+from .unet1d.attention import FeedForward
+from .attention_tuning import time_denoiser
+
+def width_level(name, n_levels):
+    # resolution level of a UNet parameter / module, None for the shared stem
+    parts = name.split('.')
+    if parts[0] == 'down_blocks':
+        return int(parts[1])
+    if parts[0] == 'up_blocks':
+        return n_levels - 1 - int(parts[1])
+    if parts[0] == 'mid_block':
+        return n_levels - 1
+    return None
+
+@torch.no_grad()
+def collect_importance(model, batches):
+    # mean |activation| per output channel of every UNet block and per head of every attention,
+    # accumulated over calibration batches run through the training forward (random t)
+    unet = model.decoder.denoise_fn
+    n_levels = len(unet.config.block_out_channels)
+    channels = [0.] * n_levels
+    heads = {}
+    hooks = []
+
+    def channel_hook(level):
+        def hook(module, inputs, output):
+            if isinstance(output, tuple):
+                output = output[0]
+            channels[level] = channels[level] + output.detach().float().abs().mean((0, 2))
+        return hook
+
+    def head_hook(name, n_heads):
+        def hook(module, inputs):
+            x = inputs[0].detach().float()  # [B, T, heads * head_dim]
+            score = x.reshape(*x.shape[:2], n_heads, -1).norm(dim=-1).mean((0, 1))
+            heads[name] = heads.get(name, 0.) + score
+        return hook
+
+    for name, module in unet.named_modules():
+        if name.count('.') == 1 and name.split('.')[0] in ('down_blocks', 'up_blocks') or name == 'mid_block':
+            hooks.append(module.register_forward_hook(channel_hook(width_level(name, n_levels))))
+        if isinstance(module, Attention):
+            hooks.append(module.to_out[0].register_forward_pre_hook(head_hook(name, module.heads)))
+    try:
+        for data in batches:
+            model(data['units'].float(), data['volume'], data['spk_id'], aug_shift=data['aug_shift'], gt_spec=data['mel'].float(), infer=False)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return channels, heads
+
+def child_block_out_channels(block_out_channels, keep_ratio, n_heads, norm_groups=8):
+    # rounded so the pruned widths still split into the norm groups and attention heads
+    multiple = norm_groups * n_heads // math.gcd(norm_groups, n_heads)
+    return [max(multiple, int(round(c * keep_ratio / multiple)) * multiple) for c in block_out_channels]
+
+def width_index_sets(channels, child_channels):
+    # the most important channels of every level, kept in their original order
+    return [score.topk(width).indices.sort().values for score, width in zip(channels, child_channels)]
+
+def channel_dims(unet, prefix=''):
+    # {param name: per leading dim, the channel spaces it is made of}. a space is a level (that level's
+    # block width), ('heads', n) for the per-head attention inner dim, or None for a hidden dim of its own.
+    # follows the forward: every input dim is mapped to the level that produced it, skips included
+    dims = {}
+
+    def add(module_name, module, *segments):
+        for name, param in module.named_parameters(prefix=prefix + module_name, recurse=False):
+            dims[name] = segments if name.endswith('weight') else segments[:1]
+
+    def resnet(name, module, in_levels, level):
+        add(f'{name}.norm1', module.norm1, in_levels)
+        add(f'{name}.conv1', module.conv1, [level], in_levels)
+        if module.time_emb_proj is not None:
+            # scale_shift projects to scale and shift of every channel
+            add(f'{name}.time_emb_proj', module.time_emb_proj, [level] * (module.time_emb_proj.out_features // module.out_channels), [None])
+        add(f'{name}.norm2', module.norm2, [level])
+        add(f'{name}.conv2', module.conv2, [level], [level])
+        if module.conv_shortcut is not None:
+            add(f'{name}.conv_shortcut', module.conv_shortcut, [level], in_levels)
+
+    def transformer(name, module, level):
+        add(f'{name}.norm', module.norm, [level])
+        add(f'{name}.proj_in', module.proj_in, [level], [level])
+        add(f'{name}.proj_out', module.proj_out, [level], [level])
+        for sub_name, sub in module.transformer_blocks.named_modules(prefix=f'{name}.transformer_blocks'):
+            if isinstance(sub, torch.nn.LayerNorm):
+                add(sub_name, sub, [level])
+            elif isinstance(sub, Attention):
+                heads = [('heads', sub.heads)]
+                for proj in ('to_q', 'to_k', 'to_v'):
+                    add(f'{sub_name}.{proj}', getattr(sub, proj), heads, [level])
+                add(f'{sub_name}.to_out.0', sub.to_out[0], [level], heads)
+            elif isinstance(sub, FeedForward):
+                # geglu: hidden and gate halves
+                add(f'{sub_name}.net.0.proj', sub.net[0].proj, [None] * (sub.net[0].proj.out_features // sub.net[2].in_features), [level])
+                add(f'{sub_name}.net.2', sub.net[2], [level], [None])
+
+    n_levels = len(unet.config['block_out_channels'])
+    add('conv_in', unet.conv_in, [0])
+    skips = [0]
+    for i, block in enumerate(unet.down_blocks):
+        level = i
+        for j, module in enumerate(block.resnets):
+            resnet(f'down_blocks.{i}.resnets.{j}', module, [skips[-1] if j == 0 else i], i)
+            if getattr(block, 'attentions', None) is not None:
+                transformer(f'down_blocks.{i}.attentions.{j}', block.attentions[j], i)
+            skips.append(i)
+        if block.downsamplers is not None:
+            add(f'down_blocks.{i}.downsamplers.0.conv', block.downsamplers[0].conv, [i], [i])
+            skips.append(i)
+    for j, module in enumerate(unet.mid_block.resnets):
+        resnet(f'mid_block.resnets.{j}', module, [level], level)
+    for j, module in enumerate(unet.mid_block.attentions):
+        transformer(f'mid_block.attentions.{j}', module, level)
+    for i, block in enumerate(unet.up_blocks):
+        out_level = n_levels - 1 - i
+        for j, module in enumerate(block.resnets):
+            # hidden states concatenated with the popped skip
+            resnet(f'up_blocks.{i}.resnets.{j}', module, [level, skips.pop()], out_level)
+            if getattr(block, 'attentions', None) is not None:
+                transformer(f'up_blocks.{i}.attentions.{j}', block.attentions[j], out_level)
+            level = out_level
+        if block.upsamplers is not None:
+            add(f'up_blocks.{i}.upsamplers.0.conv', block.upsamplers[0].conv, [level], [level])
+    if unet.conv_norm_out is not None:
+        add('conv_norm_out', unet.conv_norm_out, [0])
+    add('conv_out', unet.conv_out, [None], [0])
+    return dims
+
+def segment_index(segments, parent_size, child_size, block_out_channels, index_sets):
+    # parent indices of the child channels of one dim: a level takes its index set, the per-head dim keeps the
+    # leading channels of every head, hidden segments split the rest evenly and keep their leading channels
+    if len(segments) == 1 and isinstance(segments[0], tuple):
+        n_heads = segments[0][1]
+        parent_head, child_head = parent_size // n_heads, child_size // n_heads
+        return torch.cat([h * parent_head + torch.arange(child_head) for h in range(n_heads)])
+    levels = [s for s in segments if s is not None]
+    n_hidden = len(segments) - len(levels)
+    if n_hidden > 0:
+        parent_hidden = (parent_size - sum(block_out_channels[l] for l in levels)) // n_hidden
+        child_hidden = (child_size - sum(len(index_sets[l]) for l in levels)) // n_hidden
+    parts, offset = [], 0
+    for s in segments:
+        if s is None:
+            parts.append(offset + torch.arange(child_hidden))
+            offset += parent_hidden
+        else:
+            parts.append(offset + index_sets[s].cpu())
+            offset += block_out_channels[s]
+    return torch.cat(parts)
+
+def slice_state_dict(parent_state, child_state, dims, block_out_channels, index_sets):
+    # copies the parent into the narrower child along the channel spaces of `dims` (see channel_dims).
+    # dims it does not describe (time embedding) keep the leading channels,
+    # tensors that still do not fit stay at the child's random init
+    sliced = {}
+    for key, child in child_state.items():
+        if key not in parent_state or parent_state[key].dim() != child.dim():
+            sliced[key] = child
+            continue
+        weight = parent_state[key]
+        segments = dims.get(key, ())
+        for dim, (size, child_size) in enumerate(zip(weight.shape, child.shape)):
+            if dim < len(segments):
+                index = segment_index(segments[dim], size, child_size, block_out_channels, index_sets)
+                if len(index) == child_size:
+                    weight = weight.index_select(dim, index.to(weight.device))
+            elif size != child_size:
+                weight = weight.narrow(dim, 0, min(size, child_size))
+        sliced[key] = weight.clone() if weight.shape == child.shape else child
+    return sliced
+
+def param_count(model):
+    return sum(p.numel() for p in model.parameters())
+
+def head_report(heads):
+    # attention inner dim is tied to the block width here, so heads only shrink with it;
+    # the scores show which heads carry the least and are reported for inspection
+    return {name: [round(s, 6) for s in (score / score.sum()).tolist()] for name, score in heads.items()}
+
+def compare(parent, child, n_hidden, device, lengths=(256, 1024), method='dpm-solver', infer_speedup=10, seed=0):
+    # per-call denoiser latency and full-sampler wall time of both models, and the latent rmse
+    # of the child against the parent sampled from the same noise
+    report = []
+    for n_frames in lengths:
+        cond = torch.randn(1, n_frames, n_hidden, device=device, generator=torch.Generator(device).manual_seed(seed))
+        result = {'n_frames': n_frames}
+        for name, model in (('parent', parent), ('child', child)):
+            result[f'{name}_denoiser_time'] = time_denoiser(model.decoder, n_frames, device)
+            run_sampler(model.decoder, cond, method, infer_speedup, seed)  # warmup
+            x, result[f'{name}_wall_time'] = run_sampler(model.decoder, cond, method, infer_speedup, seed)
+            if name == 'parent':
+                reference = x
+        result['speedup'] = result['parent_wall_time'] / result['child_wall_time']
+        result['latent_rmse'] = (x - reference).pow(2).mean().sqrt().item()
+        print(result)
+        report.append(result)
+    return report
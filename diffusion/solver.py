@@ -3,10 +3,46 @@ import torch
 import librosa
 from tools.saver import Saver, Saver_empty
 from tools.tools import clip_grad_value_
+from tools.async_validation import watch_checkpoints, worker_device, start_worker, finish_worker
+from diffusion.lora_adapter import lora_state_dict
 from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn, MofNCompleteColumn
 progress = Progress(TextColumn("Running: "), BarColumn(), "[progress.percentage]{task.percentage:>3.1f}%", "•", MofNCompleteColumn(), "•", TimeElapsedColumn(), "|", TimeRemainingColumn(), "•", TextColumn("[progress.description]{task.description}"))
 
-def test(args, model, vocoder, loader_test, quantizer, saver, accelerator):
+def get_distill_steps(args, global_step):
+    # progressive distillation halves the student steps every `stage_steps` optimizer steps
+    stage = max(global_step - 1, 0) // args['diffusion']['distill']['stage_steps']
+    return max(args['diffusion']['distill']['start_steps'] // 2 ** stage, args['diffusion']['distill']['end_steps'])
+
+def load_stage_teacher(args, distill_steps):
+    # teacher of a later distillation stage, saved by train() at the stage boundary
+    path = os.path.join(args['diffusion']['train']['expdir'], 'teacher.pt')
+    if os.path.exists(path):
+        ckpt = torch.load(path, map_location='cpu')
+        if get_distill_steps(args, ckpt['global_step']) == distill_steps:
+            return ckpt['model']
+    raise ValueError(f' [x] Can not resume inside the {distill_steps}-step distillation stage: {path} does not hold its teacher')
+
+def get_reference(args, vocoder, data, references):
+    # vocoded ground-truth mel and the original wav of a validation item, computed on first use;
+    # they do not change between validations, so `references` lives for the whole run
+    fn = data['name'][0]
+    if fn not in references:
+        gt_wav = vocoder.infer(data['mel'])
+        gt_mel = vocoder.vocoder.get_mel(gt_wav[0,...])
+        path_audio = os.path.join(args['data']['valid_path'], 'audio', data['name_ext'][0])
+        audio, sr = librosa.load(path_audio, sr=args['data']['sampling_rate'])
+        if len(audio.shape) > 1:
+            audio = librosa.to_mono(audio)
+        references[fn] = (gt_mel.cpu(), torch.from_numpy(audio).unsqueeze(0))
+    return references[fn]
+
+def test(args, model, vocoder, loader_test, quantizer, saver, accelerator, infer_speedup=None, method=None, references=None):
+    if references is None:
+        references = {}
+    if infer_speedup is None:
+        infer_speedup = args['common']['infer']['speedup']
+    if method is None:
+        method = args['common']['infer']['method']
     model.eval()
 
     test_loss = 0.
@@ -47,8 +83,10 @@ def test(args, model, vocoder, loader_test, quantizer, saver, accelerator):
                 data['spk_id'],
                 gt_spec=data['mel'],
                 infer=True,
-                infer_speedup=args['common']['infer']['speedup'],
-                method=args['common']['infer']['method'],
+                infer_speedup=infer_speedup,
+                method=method,
+                atol=args['common']['infer'].get('atol', 0.0078),
+                rtol=args['common']['infer'].get('rtol', 0.05),
                 )
             
             signal = vocoder.infer(mel)
@@ -64,16 +102,11 @@ def test(args, model, vocoder, loader_test, quantizer, saver, accelerator):
             test_loss += loss.item()
             test_loss += commit_loss
 
-            gt_wav = vocoder.infer(data['mel'])
-            gt_mel = vocoder.vocoder.get_mel(gt_wav[0,...])
+            gt_mel, audio = get_reference(args, vocoder, data, references)
             mel = vocoder.vocoder.get_mel(signal[0,...])
-            saver.log_spec(data['name'][0], gt_mel, mel)
+            saver.log_spec(data['name'][0], gt_mel.to(mel), mel)
 
-            path_audio = os.path.join(args['data']['valid_path'], 'audio', data['name_ext'][0])
-            audio, sr = librosa.load(path_audio, sr=args['data']['sampling_rate'])
-            if len(audio.shape) > 1:
-                audio = librosa.to_mono(audio)
-            audio = torch.from_numpy(audio).unsqueeze(0).to(signal)
+            audio = audio.to(signal)
             saver.log_audio({fn + '/gt.wav': audio, fn + '/pred.wav': signal})
             progress.update(test_task, advance=1)
 
@@ -84,7 +117,43 @@ def test(args, model, vocoder, loader_test, quantizer, saver, accelerator):
     progress.remove_task(test_task)
     return test_loss
 
-def train(args, initial_global_step, model, optimizer, scheduler, vocoder, loader_train, loader_test,quantizer, accelerator):
+def quantizer_type(args):
+    if not args['text2semantic']['train']['use_units_quantize']:
+        return None
+    return args['text2semantic']['train']['units_quantize_type']
+
+def validation_worker(args, initial_global_step, device, poll_interval=30):
+    # runs in its own process: evaluates the checkpoints the trainer saves and logs them under their step
+    from tools.utils import DotDict
+    from diffusion.vocoder import Vocoder
+    from diffusion.unit2mel import load_svc_model
+    from diffusion.data_loaders import get_data_loaders
+    args = DotDict(args)
+    args['diffusion']['train']['cache_all_data'] = False
+    vocoder = Vocoder(args['common']['vocoder']['type'], args['common']['vocoder']['ckpt'], device=device)
+    model = load_svc_model(args=args, vocoder_dimension=vocoder.dimension).to(device)
+    _, loader_test = get_data_loaders(args, whole_audio=False)
+    quantizer = None
+    if quantizer_type(args) == 'kmeans':
+        from quantize.kmeans_codebook import EuclideanCodebook
+        from cluster import get_cluster_model
+        codebook_weight = get_cluster_model(args['text2semantic']['model']['codebook_path']).__dict__["cluster_centers_"]
+        quantizer = EuclideanCodebook(codebook_weight).to(device)
+    saver = Saver(args, initial_global_step=initial_global_step)
+    references = {}
+
+    def evaluate(step, path):
+        model.load_state_dict(torch.load(path, map_location=torch.device(device))['model'])
+        saver.global_step = step
+        if args['common']['infer']['method'] == 'distilled':
+            test_loss = test(args, model, vocoder, loader_test, quantizer, saver, worker_device(device), infer_speedup=model.decoder.k_step // get_distill_steps(args, step), method='distilled', references=references)
+        else:
+            test_loss = test(args, model, vocoder, loader_test, quantizer, saver, worker_device(device), references=references)
+        saver.log_value({'val/loss': test_loss})
+
+    watch_checkpoints(args['diffusion']['train']['expdir'], evaluate, start_step=initial_global_step, poll_interval=poll_interval)
+
+def train(args, initial_global_step, model, optimizer, scheduler, vocoder, loader_train, loader_test,quantizer, accelerator, teacher=None, lora=False, distill='steps'):
     if accelerator.is_main_process:
         saver = Saver(args, initial_global_step=initial_global_step)
     else:
@@ -93,60 +162,95 @@ def train(args, initial_global_step, model, optimizer, scheduler, vocoder, loade
     clip_grad_norm = float(args['diffusion']['train']['clip_grad_norm']) if args['diffusion']['train']['clip_grad_norm'] != -1 else None
 
     device = accelerator.device
+    global_step = initial_global_step
+    distill_steps = None
+    references = {}
+    # lora checkpoints hold only the adapter and a vq codebook trains along, both are validated in the loop
+    async_val = args['diffusion']['train'].get('async_val', False) and not lora and quantizer_type(args) != 'vq'
+    worker = None
+    if async_val and accelerator.is_main_process:
+        worker = start_worker(args['diffusion']['train']['expdir'], validation_worker, dict(args), initial_global_step, args['diffusion']['train'].get('val_device', 'cpu'), args['diffusion']['train'].get('val_poll_interval', 30))
 
     num_batches = len(loader_train)
     start_epoch = initial_global_step // num_batches
     model.train()
-    with progress:
-        train_task = progress.add_task("Train", total=num_batches - 1)
-        for epoch in range(start_epoch, args['diffusion']['train']['epochs']):
-            for _, data in enumerate(loader_train):
-                with accelerator.accumulate(model):
-                    if accelerator.sync_gradients:
-                        saver.global_step_increment()
-
-                    optimizer.zero_grad()
-
-                    for k in data.keys():
-                        if type(data[k]) is torch.Tensor:
-                            data[k] = data[k].to(device)
-
-                    if quantizer is not None:
-                        if args['text2semantic']['train']['units_quantize_type'] == "kmeans":
-                            data['units'] = quantizer(data['units']).detach()
-                            commit_loss = 0
-                        elif args['text2semantic']['train']['units_quantize_type'] == "vq":
-                            data['units'], indices, commit_loss = quantizer(data['units'])
+    try:
+        with progress:
+            train_task = progress.add_task("Train", total=num_batches - 1)
+            for epoch in range(start_epoch, args['diffusion']['train']['epochs']):
+                for _, data in enumerate(loader_train):
+                    with accelerator.accumulate(model):
+                        if accelerator.sync_gradients:
+                            saver.global_step_increment()
+                            global_step += 1
+
+                        optimizer.zero_grad()
+
+                        for k in data.keys():
+                            if type(data[k]) is torch.Tensor:
+                                data[k] = data[k].to(device)
+
+                        if quantizer is not None:
+                            if args['text2semantic']['train']['units_quantize_type'] == "kmeans":
+                                data['units'] = quantizer(data['units']).detach()
+                                commit_loss = 0
+                            elif args['text2semantic']['train']['units_quantize_type'] == "vq":
+                                data['units'], indices, commit_loss = quantizer(data['units'])
+                            else:
+                                raise ValueError('[x] Unknown quantize_type: ' + args['text2semantic']['train']['units_quantize_type'])
                         else:
-                            raise ValueError('[x] Unknown quantize_type: ' + args['text2semantic']['train']['units_quantize_type'])
-                    else:
-                        commit_loss = 0
+                            commit_loss = 0
 
-                    loss = model(data['units'].float(), data['volume'], data['spk_id'], aug_shift=data['aug_shift'], gt_spec=data['mel'].float(), infer=False) + commit_loss
+                        if teacher is not None and distill == 'width':
+                            loss = model(data['units'].float(), data['volume'], data['spk_id'], aug_shift=data['aug_shift'], gt_spec=data['mel'].float(), infer=False, teacher=teacher) + commit_loss
+                        elif teacher is not None:
+                            current_steps = get_distill_steps(args, global_step)
+                            if current_steps != distill_steps:
+                                first_stage = current_steps == args['diffusion']['distill']['start_steps']
+                                if distill_steps is not None or not first_stage and get_distill_steps(args, global_step - 1) != current_steps:
+                                    # a new stage distills from the student of the previous one,
+                                    # saved so that a resume inside the stage gets the same teacher back
+                                    teacher.load_state_dict(accelerator.unwrap_model(model).state_dict())
+                                    saver.save_model(teacher, None, name='teacher')
+                                elif not first_stage:
+                                    teacher.load_state_dict(load_stage_teacher(args, current_steps))
+                                distill_steps = current_steps
+                            loss = model(data['units'].float(), data['volume'], data['spk_id'], aug_shift=data['aug_shift'], gt_spec=data['mel'].float(), infer=False, teacher=teacher, distill_steps=distill_steps) + commit_loss
+                        else:
+                            loss = model(data['units'].float(), data['volume'], data['spk_id'], aug_shift=data['aug_shift'], gt_spec=data['mel'].float(), infer=False) + commit_loss
                     
-                    accelerator.backward(loss)
-                    grad_norm = clip_grad_value_(model.parameters(), clip_grad_norm)
-                    optimizer.step()
-                    scheduler.step()
+                        accelerator.backward(loss)
+                        grad_norm = clip_grad_value_(model.parameters(), clip_grad_norm)
+                        optimizer.step()
+                        scheduler.step()
                 
-                if accelerator.is_main_process:
-                    current_lr = optimizer.param_groups[0]['lr']
-                    vq_loss = commit_loss.item() if isinstance(commit_loss, torch.Tensor) else 0
-                    progress.update(train_task, advance=1, description=f"epoch={epoch}, step={saver.global_step}, lr={current_lr:.7f}, loss={loss.item():.4f}, vq_loss={vq_loss:.4f}, grad_norm={grad_norm:.4f}")
-
-                if accelerator.is_main_process and saver.global_step % args['diffusion']['train']['interval_log'] == 0:
-                    saver.log_value({'train/loss': loss.item()})
-                    saver.log_value({'train/vq_loss': commit_loss.item() if type(commit_loss) is torch.Tensor else 0})
-                    saver.log_value({'train/grad_norm': grad_norm})
-                    saver.log_value({'train/lr': current_lr})
+                    if accelerator.is_main_process:
+                        current_lr = optimizer.param_groups[0]['lr']
+                        vq_loss = commit_loss.item() if isinstance(commit_loss, torch.Tensor) else 0
+                        progress.update(train_task, advance=1, description=f"epoch={epoch}, step={saver.global_step}, lr={current_lr:.7f}, loss={loss.item():.4f}, vq_loss={vq_loss:.4f}, grad_norm={grad_norm:.4f}")
+
+                    if accelerator.is_main_process and saver.global_step % args['diffusion']['train']['interval_log'] == 0:
+                        saver.log_value({'train/loss': loss.item()})
+                        saver.log_value({'train/vq_loss': commit_loss.item() if type(commit_loss) is torch.Tensor else 0})
+                        saver.log_value({'train/grad_norm': grad_norm})
+                        saver.log_value({'train/lr': current_lr})
                     
-                    if args['text2semantic']['train']['units_quantize_type'] == "vq":
-                        saver.save_model(quantizer, None, postfix=f'{saver.global_step}_semantic_codebook')
-
-                    unwrap_model = accelerator.unwrap_model(model)
-                    test_loss = test(args, unwrap_model, vocoder, loader_test, quantizer, saver, accelerator)
-                    saver.log_value({'val/loss': test_loss})
-                    saver.save_model(unwrap_model, optimizer, postfix=f'{saver.global_step}')
-                    model.train()
-                accelerator.wait_for_everyone()
-            progress.reset(train_task)
\ No newline at end of file
+                        if args['text2semantic']['train']['units_quantize_type'] == "vq":
+                            saver.save_model(quantizer, None, postfix=f'{saver.global_step}_semantic_codebook')
+
+                        unwrap_model = accelerator.unwrap_model(model)
+                        # with async_val the worker picks the checkpoint up and logs val/loss for this step
+                        if not async_val:
+                            if teacher is not None and distill == 'steps':
+                                test_loss = test(args, unwrap_model, vocoder, loader_test, quantizer, saver, accelerator, infer_speedup=unwrap_model.decoder.k_step // distill_steps, method='distilled', references=references)
+                            else:
+                                test_loss = test(args, unwrap_model, vocoder, loader_test, quantizer, saver, accelerator, references=references)
+                            saver.log_value({'val/loss': test_loss})
+                        # lora runs only save the adapter weights
+                        saver.save_model(unwrap_model, optimizer, postfix=f'{saver.global_step}', state_dict=lora_state_dict(unwrap_model) if lora else None)
+                        model.train()
+                    accelerator.wait_for_everyone()
+                progress.reset(train_task)
+    finally:
+        if worker is not None:
+            finish_worker(args['diffusion']['train']['expdir'], worker)
\ No newline at end of file
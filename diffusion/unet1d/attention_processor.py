@@ -1547,11 +1547,144 @@ class SlicedAttnAddedKVProcessor:
         return hidden_states
 
 
+class LocalAttnProcessor:
+    r"""
+    Processor for implementing sliding-window (banded) self-attention along the sequence axis.
+
+    Every query attends to the keys within `window_size // 2` positions of itself, so the cost is O(T * window_size)
+    instead of O(T^2). The first `num_global_tokens` positions are global: they attend to and are attended by the
+    whole sequence. Falls back to full attention when `encoder_hidden_states` has a different length.
+
+    Args:
+        window_size (`int`):
+            The width of the attention band, in tokens.
+        num_global_tokens (`int`, defaults to 0):
+            The number of leading tokens that use full attention.
+    """
+
+    def __init__(self, window_size, num_global_tokens=0):
+        if window_size < 1:
+            raise ValueError(f"window_size has to be positive, got {window_size}.")
+        self.window_size = window_size
+        self.num_global_tokens = num_global_tokens
+        self._mask_cache = {}
+
+    def get_local_mask(self, sequence_length, device):
+        # [num_blocks, block, 3 * block] boolean mask of the allowed (query, key) pairs, keys are the
+        # previous, current and next block of each query block
+        # the cache is replaced, never mutated, and read once, so concurrent callers never see a missing key
+        key = (sequence_length, str(device))
+        mask = self._mask_cache.get(key)
+        if mask is None:
+            block = self.window_size
+            num_blocks = -(-sequence_length // block)
+            q_pos = torch.arange(num_blocks * block, device=device).view(num_blocks, block, 1)
+            k_pos = (torch.arange(num_blocks, device=device) * block - block).view(num_blocks, 1, 1) + torch.arange(
+                3 * block, device=device
+            ).view(1, 1, -1)
+            mask = ((q_pos - k_pos).abs() <= block // 2) & (k_pos >= self.num_global_tokens) & (k_pos < sequence_length)
+            self._mask_cache = {key: mask}
+        return mask
+
+    def __call__(self, attn: Attention, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None):
+        if attention_mask is not None:
+            raise ValueError("LocalAttnProcessor does not support attention_mask.")
+        query_length = hidden_states.shape[1] if hidden_states.ndim == 3 else hidden_states.shape[2] * hidden_states.shape[3]
+        if encoder_hidden_states is not None and encoder_hidden_states.shape[1] != query_length:
+            return AttnProcessor()(attn, hidden_states, encoder_hidden_states=encoder_hidden_states, temb=temb)
+
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = hidden_states.shape
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        # (batch, heads, seq_len, head_dim)
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        block = self.window_size
+        num_blocks = -(-sequence_length // block)
+        pad = num_blocks * block - sequence_length
+        num_global = min(self.num_global_tokens, sequence_length)
+
+        query_blocks = F.pad(query, (0, 0, 0, pad)).view(batch_size, attn.heads, num_blocks, block, head_dim)
+        # (batch, heads, num_blocks, 3 * block, head_dim)
+        key_blocks = F.pad(key, (0, 0, block, block + pad)).unfold(2, 3 * block, block).transpose(-1, -2)
+        value_blocks = F.pad(value, (0, 0, block, block + pad)).unfold(2, 3 * block, block).transpose(-1, -2)
+
+        scores = torch.matmul(query_blocks, key_blocks.transpose(-1, -2)) * attn.scale
+        if attn.upcast_softmax:
+            scores = scores.float()
+        scores = scores.masked_fill(~self.get_local_mask(sequence_length, query.device), float("-inf"))
+
+        if num_global > 0:
+            # every query also attends to the global keys
+            global_scores = torch.matmul(query_blocks, key[:, :, :num_global].transpose(-1, -2).unsqueeze(2)) * attn.scale
+            probs = torch.cat([global_scores.to(scores.dtype), scores], dim=-1).softmax(dim=-1).to(value.dtype)
+            hidden_states = torch.matmul(probs[..., :num_global], value[:, :, :num_global].unsqueeze(2))
+            hidden_states = hidden_states + torch.matmul(probs[..., num_global:], value_blocks)
+        else:
+            probs = scores.softmax(dim=-1).to(value.dtype)
+            hidden_states = torch.matmul(probs, value_blocks)
+
+        hidden_states = hidden_states.reshape(batch_size, attn.heads, num_blocks * block, head_dim)[:, :, :sequence_length]
+
+        if num_global > 0:
+            # global queries attend to the whole sequence
+            global_probs = torch.matmul(query[:, :, :num_global], key.transpose(-1, -2)) * attn.scale
+            global_probs = global_probs.softmax(dim=-1).to(value.dtype)
+            hidden_states = torch.cat([torch.matmul(global_probs, value), hidden_states[:, :, num_global:]], dim=2)
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
 AttentionProcessor = Union[
     AttnProcessor,
     AttnProcessor2_0,
     XFormersAttnProcessor,
     SlicedAttnProcessor,
+    LocalAttnProcessor,
     AttnAddedKVProcessor,
     SlicedAttnAddedKVProcessor,
     AttnAddedKVProcessor2_0,
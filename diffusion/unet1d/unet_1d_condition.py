@@ -21,7 +21,7 @@ import torch.utils.checkpoint
 from .outputs import BaseOutput
 
 from .activations import get_activation
-from .attention_processor import AttentionProcessor, AttnProcessor
+from .attention_processor import AttentionProcessor, AttnProcessor, LocalAttnProcessor
 from .embeddings import (
     GaussianFourierProjection,
     ImageHintTimeEmbedding,
@@ -671,6 +671,28 @@ class UNet1DConditionModel(nn.Module):
         """
         self.set_attn_processor(AttnProcessor())
 
+    def set_local_attention(self, window_size, num_global_tokens=0):
+        r"""
+        Enable sliding-window attention computation.
+
+        Args:
+            window_size (`int` or `dict`):
+                The attention band width for every attention layer. If a dict, maps a module name prefix (e.g.
+                `"down_blocks.0"`, `"mid_block"`) to a band width; the longest matching prefix wins, and layers that
+                match no prefix or map to `None` keep their current processor.
+            num_global_tokens (`int`, *optional*, defaults to 0):
+                The number of leading tokens that attend to and are attended by the whole sequence.
+        """
+        processors = {}
+        for name, processor in self.attn_processors.items():
+            if isinstance(window_size, dict):
+                prefixes = [p for p in window_size.keys() if name == p or name.startswith(p + ".")]
+                window = window_size[max(prefixes, key=len)] if len(prefixes) > 0 else None
+            else:
+                window = window_size
+            processors[name] = processor if window is None else LocalAttnProcessor(window, num_global_tokens)
+        self.set_attn_processor(processors)
+
     def set_attention_slice(self, slice_size):
         r"""
         Enable sliced attention computation.
@@ -1034,3 +1056,78 @@ class UNet1DConditionModel(nn.Module):
             return (sample,)
 
         return UNet1DConditionOutput(sample=sample)
+
+    def forward_cached(self, sample, timestep, cache, cache_depth=1, refresh=True):
+        r"""
+        Forward pass that reuses deep features across sampler steps.
+
+        With `refresh` the full network runs and the input of the last `cache_depth` up blocks is stored in `cache`.
+        Otherwise only `conv_in`, the first `cache_depth` down blocks and the last `cache_depth` up blocks run, on top
+        of the cached deep feature. Timestep, class and added embeddings other than the time embedding are not
+        supported.
+
+        Args:
+            sample (`torch.FloatTensor`): The noisy input tensor of shape `(batch, channel, frames)`.
+            timestep (`torch.Tensor` or `float` or `int`): The timestep of this evaluation.
+            cache (`dict`): Holds the deep feature between calls, empty before the first (refresh) call.
+            cache_depth (`int`, *optional*, defaults to 1): The number of shallow resolution levels recomputed on
+                every call, between 1 and `len(block_out_channels) - 1`.
+            refresh (`bool`, *optional*, defaults to `True`): Whether to run the full network and refresh the cache.
+
+        Returns:
+            `torch.FloatTensor`: The predicted noise.
+        """
+        n_up = len(self.up_blocks)
+        if not 1 <= cache_depth < n_up:
+            raise ValueError(f"cache_depth should be between 1 and {n_up - 1}, got {cache_depth}")
+        refresh = refresh or "deep" not in cache
+
+        forward_upsample_size = sample.shape[-1] % 2**self.num_upsamplers != 0
+        upsample_size = None
+
+        if not torch.is_tensor(timestep):
+            timestep = torch.tensor([timestep], device=sample.device)
+        elif len(timestep.shape) == 0:
+            timestep = timestep[None].to(sample.device)
+        t_emb = self.time_proj(timestep.expand(sample.shape[0])).to(dtype=sample.dtype)
+        emb = self.time_embedding(t_emb)
+        if self.time_embed_act is not None:
+            emb = self.time_embed_act(emb)
+
+        sample = self.conv_in(sample)
+        down_blocks = self.down_blocks if refresh else self.down_blocks[:cache_depth]
+        down_block_res_samples = (sample,)
+        for downsample_block in down_blocks:
+            sample, res_samples = downsample_block(hidden_states=sample, temb=emb)
+            down_block_res_samples += res_samples
+
+        if refresh:
+            if self.mid_block is not None:
+                sample = self.mid_block(sample, emb)
+            up_blocks = enumerate(self.up_blocks)
+        else:
+            # the skips the shallow up blocks consume are exactly the leading ones
+            n_res = sum(len(upsample_block.resnets) for upsample_block in self.up_blocks[n_up - cache_depth :])
+            down_block_res_samples = down_block_res_samples[:n_res]
+            sample = cache["deep"]
+            up_blocks = zip(range(n_up - cache_depth, n_up), self.up_blocks[n_up - cache_depth :])
+
+        for i, upsample_block in up_blocks:
+            if refresh and i == n_up - cache_depth:
+                cache["deep"] = sample
+            is_final_block = i == n_up - 1
+
+            res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
+            down_block_res_samples = down_block_res_samples[: -len(upsample_block.resnets)]
+
+            if not is_final_block and forward_upsample_size:
+                upsample_size = down_block_res_samples[-1].shape[2:]
+
+            sample = upsample_block(
+                hidden_states=sample, temb=emb, res_hidden_states_tuple=res_samples, upsample_size=upsample_size
+            )
+
+        if self.conv_norm_out:
+            sample = self.conv_norm_out(sample)
+            sample = self.conv_act(sample)
+        return self.conv_out(sample)
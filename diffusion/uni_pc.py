@@ -611,7 +611,9 @@ class UniPC:
                 step = 0
                 t = timesteps[step]
                 t_prev_list = [t]
-                model_prev_list = [self.model_fn(x, t)]
+                # The model history lives in preallocated slots, the list only rotates views into them.
+                model_prev_slots = x.new_empty((order, *x.shape)).unbind(0)
+                model_prev_list = [model_prev_slots[0].copy_(self.model_fn(x, t))]
                 if self.correcting_xt_fn is not None:
                     x = self.correcting_xt_fn(x, t, step)
                 if return_intermediate:
@@ -628,7 +630,7 @@ class UniPC:
                     if return_intermediate:
                         intermediates.append(x)
                     t_prev_list.append(t)
-                    model_prev_list.append(model_x)
+                    model_prev_list.append(model_prev_slots[step].copy_(model_x))
                     
                 # Compute the remaining values by `order`-th order multistep DPM-Solver.
                 for step in range(order, steps + 1):
@@ -649,13 +651,13 @@ class UniPC:
                         intermediates.append(x)
                     for i in range(order - 1):
                         t_prev_list[i] = t_prev_list[i + 1]
-                        model_prev_list[i] = model_prev_list[i + 1]
                     t_prev_list[-1] = t
+                    model_prev_list.append(model_prev_list.pop(0))
                     # We do not need to evaluate the final model value.
                     if step < steps:
                         if model_x is None:
                             model_x = self.model_fn(x, t)
-                        model_prev_list[-1] = model_x
+                        model_prev_list[-1].copy_(model_x)
             else:
                 raise ValueError("Got wrong method {}".format(method))
             
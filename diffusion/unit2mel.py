@@ -2,10 +2,13 @@ import os
 import yaml
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from .diffusion import GaussianDiffusion
 from .vocoder import Vocoder
+from .attention_tuning import select_attention_processor
 from .unet1d.unet_1d_condition import UNet1DConditionModel
-from tools.tools import get_encdoer_out_channels
+from tools.tools import get_encdoer_out_channels, get_autocast_dtype
+from tools.quantization import load_int8
 
 class DotDict(dict):
     def __getattr__(*args):
@@ -15,23 +18,51 @@ class DotDict(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
-def load_model_vocoder(model_path, device='cpu', loaded_vocoder=None):
+def load_model_vocoder(model_path, device='cpu', loaded_vocoder=None, precision=None, int8=None, int8_convs=None, tune_attention=None):
     config_file = os.path.join(os.path.split(model_path)[0], 'config.yaml')
     with open(config_file, "r") as config:
         args = yaml.safe_load(config)
     args = DotDict(args)
+    if precision is None:
+        precision = args['common']['infer'].get('precision', 'fp32')
+    autocast_dtype = get_autocast_dtype(precision, device)
+    if int8 is None:
+        int8 = args['common']['infer'].get('int8', False)
+    if int8 and str(device) != 'cpu':
+        raise ValueError(' [x] int8 inference is only supported on cpu')
+    if int8_convs is None:
+        int8_convs = args['common']['infer'].get('int8_convs', False)
+    int8_convs = int8 and int8_convs
 
     if loaded_vocoder is None:
-        vocoder = Vocoder(args['common']['vocoder']['type'], args['common']['vocoder']['ckpt'], device=device)
+        vocoder = Vocoder(args['common']['vocoder']['type'], args['common']['vocoder']['ckpt'], device=device, autocast_dtype=autocast_dtype, int8=int8_convs)
     else:
         vocoder = loaded_vocoder
 
     model = load_svc_model(args=args, vocoder_dimension=vocoder.dimension)
 
-    ckpt = torch.load(model_path, map_location=torch.device(device))
-    model.to(device)
-    model.load_state_dict(ckpt['model'])
+    if int8:
+        model = load_int8(model, model_path, lambda m: m.load_state_dict(torch.load(model_path, map_location='cpu')['model']), convs=int8_convs)
+    else:
+        ckpt = torch.load(model_path, map_location=torch.device(device))
+        model.to(device)
+        model.load_state_dict(ckpt['model'])
     model.eval()
+    model.decoder.autocast_dtype = autocast_dtype
+    if args['diffusion']['model'].get('attention_window') is not None:
+        model.decoder.denoise_fn.set_local_attention(args['diffusion']['model']['attention_window'], args['diffusion']['model'].get('attention_global_tokens', 0))
+    if tune_attention is None:
+        tune_attention = args['common']['infer'].get('tune_attention', False)
+    if tune_attention:
+        if args['diffusion']['model'].get('attention_window') is not None:
+            print(' [!] attention_window is set, keeping the local attention processor')
+        else:
+            cache_path = os.path.join(os.path.split(model_path)[0], 'attention_tuning.json')
+            select_attention_processor(model.decoder, device, args['diffusion']['model'], cache_path)
+    if args['common']['infer'].get('length_buckets'):
+        # after tuning, so the compiled graphs are built for the final attention processor
+        model.decoder.set_length_buckets(args['common']['infer']['length_buckets'], compile=args['common']['infer'].get('compile', True), max_batch_size=args['common']['infer'].get('compile_max_batch_size', 8))
+    model.decoder.set_deep_cache(args['common']['infer'].get('deep_cache_interval', 0), args['common']['infer'].get('deep_cache_depth', 1))
     return model, vocoder, args
 
 def load_svc_model(args, vocoder_dimension):
@@ -44,12 +75,33 @@ def load_svc_model(args, vocoder_dimension):
                 args['diffusion']['model']['block_out_channels'],
                 args['diffusion']['model']['n_heads'],
                 args['diffusion']['model']['n_hidden'],
-                args['data']['acoustic_scale']
+                args['data']['acoustic_scale'],
+                naive_n_layers=args['diffusion']['model'].get('naive_n_layers', 0),
+                naive_n_chans=args['diffusion']['model']['n_chans']
                 )
     return model
 
+class NaiveDecoder(nn.Module):
+    # fast non-diffusion units -> latent predictor, its output seeds shallow diffusion
+    def __init__(self, n_hidden, out_dims, n_chans=512, n_layers=3, kernel_size=5):
+        super().__init__()
+        self.conv_in = nn.Conv1d(n_hidden, n_chans, kernel_size, padding=kernel_size // 2)
+        self.layers = nn.ModuleList([
+            nn.Sequential(
+                nn.GroupNorm(8, n_chans),
+                nn.SiLU(),
+                nn.Conv1d(n_chans, n_chans, kernel_size, padding=kernel_size // 2)
+            ) for _ in range(n_layers)])
+        self.conv_out = nn.Conv1d(n_chans, out_dims, 1)
+
+    def forward(self, x):  # [B, T, H] -> [B, T, M]
+        x = self.conv_in(x.transpose(1, 2))
+        for layer in self.layers:
+            x = x + layer(x)
+        return self.conv_out(x).transpose(1, 2)
+
 class Unit2Mel(nn.Module):
-    def __init__(self, input_channel, n_spk, out_dims=128, n_layers=2, block_out_channels=(256,384,512,512), n_heads=8, n_hidden=256, acoustic_scale=1.0):
+    def __init__(self, input_channel, n_spk, out_dims=128, n_layers=2, block_out_channels=(256,384,512,512), n_heads=8, n_hidden=256, acoustic_scale=1.0, naive_n_layers=0, naive_n_chans=512):
         super().__init__()
         self.unit_embed = nn.Linear(input_channel, n_hidden)
         self.aug_shift_embed = None
@@ -69,8 +121,14 @@ class Unit2Mel(nn.Module):
         only_cross_attention = True,
         layers_per_block = n_layers,
         resnet_time_scale_shift='scale_shift'), out_dims=out_dims, acoustic_scale=acoustic_scale)
+
+        if naive_n_layers > 0:
+            self.naive_decoder = NaiveDecoder(n_hidden, out_dims, n_chans=naive_n_chans, n_layers=naive_n_layers)
+        else:
+            self.naive_decoder = None
     
-    def forward(self, units, volume, spk_id=None, aug_shift=None, gt_spec=None, infer=True, infer_speedup=10, method='unipc', use_tqdm=False):
+    def embed_shared(self, units, volume, aug_shift=None):
+        # speaker independent part of the condition
         if volume is None or self.is_tts:
             volume = 0
         else:
@@ -78,12 +136,50 @@ class Unit2Mel(nn.Module):
 
         x = self.unit_embed(units) + volume
 
-        if self.n_spk is not None and self.n_spk > 1:
-            x = x + self.spk_embed(spk_id - 1)
-        
         if self.aug_shift_embed is not None and aug_shift is not None:
             x = x + self.aug_shift_embed(aug_shift / 5)
 
-        x = self.decoder(x, gt_spec=gt_spec, infer=infer, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm)
+        return x
+
+    def embed(self, units, volume, spk_id=None, aug_shift=None):
+        x = self.embed_shared(units, volume, aug_shift=aug_shift)
+
+        if self.n_spk is not None and self.n_spk > 1:
+            x = x + self.spk_embed(spk_id - 1)
+
+        return x
+
+    def embed_speakers(self, units, volume, spk_ids, aug_shift=None):
+        # [1, T, H] units of one source -> [N, T, H], one condition per speaker in spk_ids ([N])
+        x = self.embed_shared(units, volume, aug_shift=aug_shift)
+        if self.n_spk is not None and self.n_spk > 1:
+            return x + self.spk_embed(spk_ids - 1)[:, None, :]
+        return x.expand(len(spk_ids), -1, -1)
+
+    def infer_speakers(self, units, volume, spk_ids, aug_shift=None, infer_speedup=10, method='unipc', use_tqdm=False, chunk_size=None, chunk_overlap=64, k_step=None, instrument=None, atol=0.0078, rtol=0.05):
+        # one batched sampler pass for all speakers, the source is embedded once
+        x = self.embed_speakers(units, volume, spk_ids, aug_shift=aug_shift)
+        gt_spec = None
+        if k_step is not None and self.naive_decoder is not None:
+            gt_spec = self.naive_decoder(x)
+        return self.decoder(x, gt_spec=gt_spec, infer=True, infer_speedup=infer_speedup, method=method, k_step=k_step, use_tqdm=use_tqdm, chunk_size=chunk_size, chunk_overlap=chunk_overlap, instrument=instrument, atol=atol, rtol=rtol)
+
+    def forward(self, units, volume, spk_id=None, aug_shift=None, gt_spec=None, infer=True, infer_speedup=10, method='unipc', use_tqdm=False, chunk_size=None, chunk_overlap=64, teacher=None, distill_steps=None, k_step=None, instrument=None, atol=0.0078, rtol=0.05):
+        x = self.embed(units, volume, spk_id=spk_id, aug_shift=aug_shift)
+
+        if not infer and teacher is None and self.naive_decoder is not None:
+            naive_loss = F.mse_loss(self.naive_decoder(x), gt_spec)
+            return self.decoder(x, gt_spec=gt_spec, infer=False) + naive_loss
+
+        if infer and k_step is not None and gt_spec is None and self.naive_decoder is not None:
+            # shallow diffusion: only the last k_step steps refine the naive prediction
+            gt_spec = self.naive_decoder(x)
+
+        if teacher is not None:
+            with torch.no_grad():
+                teacher_condition = teacher.embed(units, volume, spk_id=spk_id, aug_shift=aug_shift)
+            return self.decoder(x, gt_spec=gt_spec, infer=False, teacher_fn=teacher.decoder.denoise_fn, teacher_condition=teacher_condition, distill_steps=distill_steps)
+
+        x = self.decoder(x, gt_spec=gt_spec, infer=infer, infer_speedup=infer_speedup, method=method, k_step=k_step, use_tqdm=use_tqdm, chunk_size=chunk_size, chunk_overlap=chunk_overlap, instrument=instrument, atol=atol, rtol=rtol)
 
         return x
\ No newline at end of file
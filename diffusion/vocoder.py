@@ -1,15 +1,19 @@
 import torch
 from torchaudio.transforms import Resample
-from encoder.hifi_vaegan.hifi_vaegan import Hifi_VAEGAN
+from encoder.hifi_vaegan.hifi_vaegan import Hifi_VAEGAN, Istft_VAEGAN
 
 class Vocoder:
-    def __init__(self, vocoder_type, vocoder_ckpt, device=None):
+    def __init__(self, vocoder_type, vocoder_ckpt, device=None, autocast_dtype=None, int8=False):
         if device is None:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.device = device
         self.vocoder_type = vocoder_type
         if vocoder_type == 'hifi-vaegan':
-            self.vocoder = Hifi_VAEGAN(vocoder_ckpt, device=device)
+            self.vocoder = Hifi_VAEGAN(vocoder_ckpt, device=device, int8=int8)
+            self.vocoder.autocast_dtype = autocast_dtype
+        elif vocoder_type == 'istft-vaegan':
+            self.vocoder = Istft_VAEGAN(vocoder_ckpt, device=device, int8=int8)
+            self.vocoder.autocast_dtype = autocast_dtype
         else:
             raise ValueError(f" [x] Unknown vocoder: {vocoder_type}")
         self.resample_kernel = {}
@@ -30,4 +34,16 @@ class Vocoder:
         return mel
 
     def infer(self, mel):
-        return self.vocoder(mel)
\ No newline at end of file
+        return self.vocoder(mel)
+
+    def warmup(self, encoder=False):
+        self.vocoder.warmup(encoder=encoder)
+
+    def infer_batch(self, mel, lengths, max_batch_frames=8192):
+        return self.vocoder.decode_batch(mel, lengths, max_batch_frames=max_batch_frames)
+
+    def infer_chunked(self, mel, chunk_size=256, overlap=4):
+        return self.vocoder.decode_chunked(mel, chunk_size=chunk_size, overlap=overlap)
+
+    def infer_stream(self, mel, chunk_size=256, overlap=4):
+        return self.vocoder.stream(mel, chunk_size=chunk_size, overlap=overlap)
\ No newline at end of file
@@ -1,14 +1,49 @@
+import math
+import json
 import torch
 import os
-from .modules.models import Generator,Encoder
+from .modules.models import Encoder, get_generator
 from .modules.nvSTFT import STFT
+from tools.quantization import load_int8
 
 def load_config(model_path):
-    h = torch.load(os.path.join(model_path, 'decoder.pth'))["config"]
+    # config.json is written by export_fused, older checkpoint dirs only have it inside decoder.pth
+    config_path = os.path.join(model_path, 'config.json')
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as f:
+            return json.load(f)
+    h = torch.load(os.path.join(model_path, 'decoder.pth'), map_location='cpu')["config"]
     return h
 
+def fused_path(model_path, name):
+    return os.path.join(model_path, f'{name}_fused.pt')
+
+def load_weights(path):
+    # mmap: tensors are paged in from the file instead of being read and copied up front
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:  # torch < 2.1
+        return torch.load(path, map_location='cpu')
+
+@torch.no_grad()
+def export_fused(model_path):
+    # one-time export: weight norm folded into plain conv weights, saved as bare state dicts
+    # in the new zipfile format (mmap-able) plus a small json config
+    h = torch.load(os.path.join(model_path, 'decoder.pth'), map_location='cpu')["config"]
+    with open(os.path.join(model_path, 'config.json'), 'w') as f:
+        json.dump(h, f, indent=2)
+    for name, model_class in (('encoder', Encoder), ('decoder', get_generator)):
+        path = os.path.join(model_path, f'{name}.pth')
+        if not os.path.exists(path):
+            continue
+        model = model_class(h)
+        model.load_state_dict(torch.load(path, map_location='cpu')["model"])
+        model.remove_weight_norm()
+        torch.save(model.state_dict(), fused_path(model_path, name))
+        print(' [*] Saved fused weights to', fused_path(model_path, name))
+
 class Hifi_VAEGAN(torch.nn.Module):
-    def __init__(self, model_path, device=None):
+    def __init__(self, model_path, device=None, int8=False):
         super().__init__()
         if device is None:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -16,6 +51,9 @@ class Hifi_VAEGAN(torch.nn.Module):
         self.model_path = model_path
         self.encoder_model = None
         self.decoder_model = None
+        self.autocast_dtype = None
+        # the generator has no Linear layers, so int8 here means weight-only int8 convs (memory, not speed)
+        self.int8 = int8
         self.h = load_config(model_path)
         self.stft = STFT(self.h["sampling_rate"], 128, 2048, 2048, 512, 40, 16000)
 
@@ -28,16 +66,39 @@ class Hifi_VAEGAN(torch.nn.Module):
     def dimension(self):
         return self.h["inter_channels"]
 
-    @torch.no_grad()
-    def extract(self, audio, only_z=False, only_mean=False):
+    def receptive_field(self):
+        # latent frames on each side that reach an output sample through the generator convs
+        h = self.h
+        field = 3  # conv_pre
+        rate = 1
+        for u, k in zip(h["upsample_rates"], h["upsample_kernel_sizes"]):
+            field += math.ceil(k / u / 2) / rate
+            rate *= u
+            if h["resblock"] == '1':
+                field += max(sum((k - 1) * d // 2 + (k - 1) // 2 for d in ds) for k, ds in zip(h["resblock_kernel_sizes"], h["resblock_dilation_sizes"])) / rate
+            else:
+                field += max(sum((k - 1) * d // 2 for d in ds) for k, ds in zip(h["resblock_kernel_sizes"], h["resblock_dilation_sizes"])) / rate
+        field += 3 / rate  # conv_post
+        return math.ceil(field)
+
+    def load_encoder(self):
         if self.encoder_model is None:
             print('| Load Vaegan Encoder: ', self.model_path)
-            state = torch.load(os.path.join(self.model_path, 'encoder.pth'))["model"]
             self.encoder_model = Encoder(self.h)
-            self.encoder_model.load_state_dict(state)
+            if os.path.exists(fused_path(self.model_path, 'encoder')):
+                self.encoder_model.remove_weight_norm()
+                self.encoder_model.load_state_dict(load_weights(fused_path(self.model_path, 'encoder')))
+            else:
+                state = torch.load(os.path.join(self.model_path, 'encoder.pth'))["model"]
+                self.encoder_model.load_state_dict(state)
+                self.encoder_model.remove_weight_norm()
             self.encoder_model.eval()
-            self.encoder_model.remove_weight_norm()
             self.encoder_model.to(self.device)
+        return self.encoder_model
+
+    @torch.no_grad()
+    def extract(self, audio, only_z=False, only_mean=False):
+        self.load_encoder()
         if audio.shape[-1] % self.hop_size() != 0: # PAD
             audio = torch.nn.functional.pad(audio, (0, self.hop_size() - audio.shape[-1] % self.hop_size()))
         z, m, logs = self.encoder_model(audio)
@@ -49,22 +110,119 @@ class Hifi_VAEGAN(torch.nn.Module):
             rtn = torch.cat([m, logs],dim=-2).transpose(-1,-2)
             return rtn
 
-    @torch.no_grad()
-    def forward(self, z):
-        z = z.transpose(-1,-2)
+    def load_decoder(self):
         if self.decoder_model is None:
             print('| Load Vaegan:', self.model_path)
-            state = torch.load(os.path.join(self.model_path, 'decoder.pth'))["model"]
-            self.decoder_model = Generator(self.h)
-            self.decoder_model.load_state_dict(state)
-            self.decoder_model.eval()
-            self.decoder_model.remove_weight_norm()
+            decoder_path = os.path.join(self.model_path, 'decoder.pth')
+            self.decoder_model = get_generator(self.h)
+            if os.path.exists(fused_path(self.model_path, 'decoder')):
+                self.decoder_model.remove_weight_norm()
+                load_fused = lambda m: m.load_state_dict(load_weights(fused_path(self.model_path, 'decoder')))
+                if self.int8:
+                    load_int8(self.decoder_model, decoder_path, load_fused, source=fused_path(self.model_path, 'decoder'), convs=True)
+                else:
+                    load_fused(self.decoder_model)
+                self.decoder_model.eval()
+            elif self.int8:
+                load_int8(self.decoder_model, decoder_path, lambda m: m.load_state_dict(torch.load(decoder_path, map_location='cpu')["model"]), prepare=lambda m: m.remove_weight_norm(), convs=True)
+                self.decoder_model.eval()
+            else:
+                state = torch.load(decoder_path)["model"]
+                self.decoder_model.load_state_dict(state)
+                self.decoder_model.eval()
+                self.decoder_model.remove_weight_norm()
             self.decoder_model.to(self.device)
+        return self.decoder_model
 
-        wav = self.decoder_model(z)
-        return wav
+    def decode(self, z):  # [B, C, T] -> [B, 1, T * hop_size]
+        self.load_decoder()
+        if self.autocast_dtype is None:
+            return self.decoder_model(z)
+        with torch.autocast(torch.device(self.device).type, dtype=self.autocast_dtype):
+            wav = self.decoder_model(z)
+        return wav.float()
+
+    @torch.no_grad()
+    def forward(self, z):
+        return self.decode(z.transpose(-1,-2))
+
+    @torch.no_grad()
+    def decode_batch(self, z, lengths, max_batch_frames=8192, max_pad_ratio=1.25):
+        # z: [B, T, C] padded latents, lengths: frames per item. items are sorted by length and
+        # grouped so that no bucket pads any item by more than max_pad_ratio or holds more than
+        # max_batch_frames padded frames; returns a list of [1, length * hop_size] waveforms
+        lengths = [int(l) for l in lengths]
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        buckets = []
+        for i in order:
+            if len(buckets) > 0:
+                bucket = buckets[-1]
+                n_frames = lengths[bucket[0]]
+                if n_frames <= lengths[i] * max_pad_ratio and n_frames * (len(bucket) + 1) <= max_batch_frames:
+                    bucket.append(i)
+                    continue
+            buckets.append([i])
+        hop = self.hop_size()
+        wavs = [None] * len(lengths)
+        for bucket in buckets:
+            n_frames = lengths[bucket[0]]
+            wav = self.forward(z[bucket, :n_frames])
+            for j, i in enumerate(bucket):
+                wavs[i] = wav[j, :, :lengths[i] * hop]
+        return wavs
+
+    @torch.no_grad()
+    def stream(self, z, chunk_size=256, overlap=4, context=None):
+        # yields the waveform of z ([B, T, C]) chunk by chunk. every chunk is decoded with `context`
+        # frames of latent on both sides (the receptive field by default, which makes the result match
+        # the full decode) and the last `overlap` frames are crossfaded into the next chunk
+        z = z.transpose(-1,-2)
+        if context is None:
+            context = self.receptive_field()
+        hop = self.hop_size()
+        n_frames = z.shape[-1]
+        fade = torch.linspace(0, 1, overlap * hop, device=z.device)
+        tail = None
+        for start in range(0, n_frames, chunk_size):
+            end = min(start + chunk_size, n_frames)
+            right = min(end + overlap, n_frames)
+            left_context = min(context, start)
+            right_context = min(context, n_frames - right)
+            wav = self.decode(z[..., start - left_context: right + right_context])
+            wav = wav[..., left_context * hop: wav.shape[-1] - right_context * hop]
+            if tail is not None:
+                n = tail.shape[-1]
+                wav[..., :n] = tail * (1 - fade[:n]) + wav[..., :n] * fade[:n]
+            tail = wav[..., (end - start) * hop:] if right > end else None
+            yield wav[..., :(end - start) * hop]
+
+    @torch.no_grad()
+    def decode_chunked(self, z, chunk_size=256, overlap=4, context=None):
+        # same output as forward, the generator activations only ever cover one chunk
+        return torch.cat(list(self.stream(z, chunk_size=chunk_size, overlap=overlap, context=context)), -1)
+
+    @torch.no_grad()
+    def warmup(self, n_frames=32, encoder=False):
+        # loads the models and runs them once, so the first request pays neither the load nor
+        # the first-call allocations / kernel selection
+        self.forward(torch.zeros(1, n_frames, self.dimension(), device=self.device))
+        if encoder:
+            self.extract(torch.zeros(1, n_frames * self.hop_size(), device=self.device))
 
     @torch.no_grad()
     def get_mel(self, audio, keyshift=0):
         mel = self.stft.get_mel(audio, keyshift=keyshift).transpose(1, 2)
-        return mel
\ No newline at end of file
+        return mel
+
+
+class Istft_VAEGAN(Hifi_VAEGAN):
+    # same encoder and latent as hifi-vaegan, the decoder stops upsampling at a coarse frame rate
+    # and synthesizes the waveform with an istft (checkpoints from 26_train_istft_vocoder.py)
+    def __init__(self, model_path, device=None, int8=False):
+        super().__init__(model_path, device=device, int8=int8)
+        if "gen_istft_n_fft" not in self.h:
+            raise ValueError(f" [x] {model_path} is not an istft vaegan checkpoint")
+
+    def receptive_field(self):
+        # plus half an istft window
+        return super().receptive_field() + math.ceil(self.h["gen_istft_n_fft"] / 2 / self.hop_size())
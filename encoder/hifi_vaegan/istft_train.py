@@ -0,0 +1,142 @@
+import os
+import random
+import shutil
+import numpy as np
+import torch
+import librosa
+from torch.utils.tensorboard import SummaryWriter
+from tools.utils import traverse_dir
+from .hifi_vaegan import Hifi_VAEGAN, load_config
+from .modules.models import ISTFTGenerator, MultiPeriodDiscriminator
+from .modules.losses import feature_loss, discriminator_loss, generator_loss, RSSLoss
+from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn, MofNCompleteColumn
+progress = Progress(TextColumn("Running: "), BarColumn(), "[progress.percentage]{task.percentage:>3.1f}%", "•", MofNCompleteColumn(), "•", TimeElapsedColumn(), "|", TimeRemainingColumn(), "•", TextColumn("[progress.description]{task.description}"))
+
+ISTFT_KEYS = ('upsample_rates', 'upsample_kernel_sizes', 'upsample_initial_channel', 'gen_istft_n_fft', 'gen_istft_hop_size')
+
+def get_istft_config(base_config, istft_args):
+    # the base vaegan config with the decoder part swapped, the latent and hop size stay the same
+    h = dict(base_config)
+    for key in ISTFT_KEYS:
+        h[key] = istft_args[key]
+    if np.prod(h['upsample_rates']) * h['gen_istft_hop_size'] != h['hop_size']:
+        raise ValueError(f" [x] prod(upsample_rates) * gen_istft_hop_size should equal the vaegan hop size {h['hop_size']}")
+    return h
+
+class WavSegments(torch.utils.data.Dataset):
+    # random fixed-length segments of the training audio
+    def __init__(self, path_root, sampling_rate, segment_size, extensions=['wav']):
+        self.paths = traverse_dir(os.path.join(path_root, 'audio'), extensions, is_sort=True)
+        self.sampling_rate = sampling_rate
+        self.segment_size = segment_size
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        audio, _ = librosa.load(self.paths[index], sr=self.sampling_rate)
+        if len(audio.shape) > 1:
+            audio = librosa.to_mono(audio)
+        if len(audio) < self.segment_size:
+            audio = np.pad(audio, (0, self.segment_size - len(audio)))
+        start = random.randint(0, len(audio) - self.segment_size)
+        return torch.from_numpy(audio[start: start + self.segment_size]).float()
+
+def get_data_loader(args):
+    train_args = args['istft_vocoder']['train']
+    h = load_config(args['istft_vocoder']['base'])
+    dataset = WavSegments(
+        args['data']['train_path'],
+        h['sampling_rate'],
+        train_args['segment_frames'] * h['hop_size'],
+        extensions=args['data']['extensions'])
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=train_args['batch_size'],
+        shuffle=True,
+        drop_last=True,
+        num_workers=train_args['num_workers'],
+        persistent_workers=train_args['num_workers'] > 0,
+        pin_memory=True)
+
+def save_checkpoint(expdir, h, global_step, generator, discriminator, optim_g, optim_d):
+    # decoder.pth has the layout Hifi_VAEGAN loads, train_state.pt is only for resuming
+    torch.save({'model': generator.state_dict(), 'config': h}, os.path.join(expdir, 'decoder.pth'))
+    torch.save({
+        'global_step': global_step,
+        'generator': generator.state_dict(),
+        'discriminator': discriminator.state_dict(),
+        'optim_g': optim_g.state_dict(),
+        'optim_d': optim_d.state_dict()}, os.path.join(expdir, 'train_state.pt'))
+
+def train(args, accelerator, loader_train):
+    istft_args = args['istft_vocoder']
+    train_args = istft_args['train']
+    expdir = istft_args['expdir']
+    device = accelerator.device
+    os.makedirs(expdir, exist_ok=True)
+
+    # latents come from the frozen encoder of the base vaegan, so the new decoder reads the same latent space
+    vaegan = Hifi_VAEGAN(istft_args['base'], device=device)
+    vaegan.load_encoder()
+    h = get_istft_config(vaegan.h, istft_args)
+    if accelerator.is_main_process:
+        shutil.copy(os.path.join(istft_args['base'], 'encoder.pth'), os.path.join(expdir, 'encoder.pth'))
+
+    generator = ISTFTGenerator(h)
+    discriminator = MultiPeriodDiscriminator()
+    optim_g = torch.optim.AdamW(generator.parameters(), train_args['lr'], betas=train_args['betas'])
+    optim_d = torch.optim.AdamW(discriminator.parameters(), train_args['lr'], betas=train_args['betas'])
+    global_step = 0
+    state_path = os.path.join(expdir, 'train_state.pt')
+    if os.path.exists(state_path):
+        print('restoring model from', state_path)
+        state = torch.load(state_path, map_location='cpu')
+        global_step = state['global_step']
+        generator.load_state_dict(state['generator'])
+        discriminator.load_state_dict(state['discriminator'])
+        optim_g.load_state_dict(state['optim_g'])
+        optim_d.load_state_dict(state['optim_d'])
+    generator, discriminator, optim_g, optim_d, loader_train = accelerator.prepare(generator, discriminator, optim_g, optim_d, loader_train)
+    spec_loss = RSSLoss(train_args['fft_min'], train_args['fft_max'], train_args['n_scale'], device=device)
+    writer = SummaryWriter(expdir) if accelerator.is_main_process else None
+
+    num_batches = len(loader_train)
+    generator.train()
+    discriminator.train()
+    with progress:
+        train_task = progress.add_task("Train", total=num_batches - 1)
+        for epoch in range(global_step // num_batches, train_args['epochs']):
+            for wav in loader_train:
+                global_step += 1
+                with torch.no_grad():
+                    z = vaegan.extract(wav, only_z=True).transpose(1, 2)
+                y = wav[:, None, :]
+                y_hat = generator(z)[..., :y.shape[-1]]
+
+                y_d_rs, y_d_gs, _, _ = discriminator(y, y_hat.detach())
+                loss_disc, _, _ = discriminator_loss(y_d_rs, y_d_gs)
+                optim_d.zero_grad()
+                accelerator.backward(loss_disc)
+                optim_d.step()
+
+                y_d_rs, y_d_gs, fmap_rs, fmap_gs = discriminator(y, y_hat)
+                loss_gen, _ = generator_loss(y_d_gs)
+                loss_fm = feature_loss(fmap_rs, fmap_gs)
+                loss_spec = spec_loss(y_hat[:, 0, :], y[:, 0, :]) * train_args['lambda_spec']
+                loss_g = loss_gen + loss_fm + loss_spec
+                optim_g.zero_grad()
+                accelerator.backward(loss_g)
+                optim_g.step()
+
+                if accelerator.is_main_process:
+                    progress.update(train_task, advance=1, description=f"epoch={epoch}, step={global_step}, loss_g={loss_g.item():.4f}, loss_d={loss_disc.item():.4f}, spec={loss_spec.item():.4f}")
+                    if global_step % train_args['interval_log'] == 0:
+                        writer.add_scalar('train/loss_g', loss_g.item(), global_step)
+                        writer.add_scalar('train/loss_d', loss_disc.item(), global_step)
+                        writer.add_scalar('train/loss_fm', loss_fm.item(), global_step)
+                        writer.add_scalar('train/loss_spec', loss_spec.item(), global_step)
+                    if global_step % train_args['interval_save'] == 0:
+                        save_checkpoint(expdir, h, global_step, accelerator.unwrap_model(generator), accelerator.unwrap_model(discriminator), optim_g, optim_d)
+                accelerator.wait_for_everyone()
+            progress.reset(train_task)
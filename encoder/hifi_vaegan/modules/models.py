@@ -271,6 +271,73 @@ class Generator(torch.nn.Module):
         remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
 
+class ISTFTGenerator(torch.nn.Module):
+    # upsamples the latent only to the frame rate of a small STFT, predicts its log-magnitude
+    # and phase and leaves the last hop (gen_istft_hop_size) to torch.istft
+    def __init__(self, h):
+        super(ISTFTGenerator, self).__init__()
+        self.h = h
+        self.num_kernels = len(h["resblock_kernel_sizes"])
+        self.num_upsamples = len(h["upsample_rates"])
+        self.n_fft = h["gen_istft_n_fft"]
+        self.hop_size = h["gen_istft_hop_size"]
+        self.conv_pre = weight_norm(Conv1d(h["inter_channels"], h["upsample_initial_channel"], 7, 1, padding=3))
+        resblock = ResBlock1 if h["resblock"] == '1' else ResBlock2
+        self.ups = nn.ModuleList()
+        for i, (u, k) in enumerate(zip(h["upsample_rates"], h["upsample_kernel_sizes"])):
+            self.ups.append(weight_norm(
+                ConvTranspose1d(h["upsample_initial_channel"] // (2 ** i), h["upsample_initial_channel"] // (2 ** (i + 1)),
+                                k, u, padding=(k - u + 1) // 2)))
+        self.resblocks = nn.ModuleList()
+        for i in range(len(self.ups)):
+            ch = h["upsample_initial_channel"] // (2 ** (i + 1))
+            for j, (k, d) in enumerate(zip(h["resblock_kernel_sizes"], h["resblock_dilation_sizes"])):
+                self.resblocks.append(resblock(h, ch, k, d))
+
+        self.reflection_pad = nn.ReflectionPad1d((1, 0))
+        self.conv_post = weight_norm(Conv1d(ch, self.n_fft + 2, 7, 1, padding=3))
+        self.ups.apply(init_weights)
+        self.conv_post.apply(init_weights)
+        self.register_buffer('window', torch.hann_window(self.n_fft), persistent=False)
+        self.upp = np.prod(h["upsample_rates"]) * self.hop_size
+
+    def forward(self, x):
+        x = self.conv_pre(x)
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, LRELU_SLOPE)
+            x = self.ups[i](x)
+            xs = None
+            for j in range(self.num_kernels):
+                if xs is None:
+                    xs = self.resblocks[i * self.num_kernels + j](x)
+                else:
+                    xs += self.resblocks[i * self.num_kernels + j](x)
+            x = xs / self.num_kernels
+        x = F.leaky_relu(x)
+        # one extra frame on the left, so the centered istft returns exactly frames * hop samples
+        x = self.reflection_pad(x)
+        x = self.conv_post(x)
+        n_bins = self.n_fft // 2 + 1
+        magnitude = torch.exp(x[:, :n_bins, :].float().clamp(max=10))
+        phase = np.pi * torch.sin(x[:, n_bins:, :].float())
+        spec = torch.polar(magnitude, phase)
+        wav = torch.istft(spec, self.n_fft, hop_length=self.hop_size, win_length=self.n_fft, window=self.window)
+        return wav.clamp(-1, 1)[:, None, :]
+
+    def remove_weight_norm(self):
+        for l in self.ups:
+            remove_weight_norm(l)
+        for l in self.resblocks:
+            l.remove_weight_norm()
+        remove_weight_norm(self.conv_pre)
+        remove_weight_norm(self.conv_post)
+
+def get_generator(h):
+    # vaegan checkpoints trained with 26_train_istft_vocoder.py carry the istft keys in their config
+    if "gen_istft_n_fft" in h:
+        return ISTFTGenerator(h)
+    return Generator(h)
+
 class MultiScaleDiscriminator(torch.nn.Module):
     def __init__(self):
         super(MultiScaleDiscriminator, self).__init__()
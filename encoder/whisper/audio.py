@@ -59,7 +59,11 @@ def mel_filters(device, n_mels: int) -> torch.Tensor:
     with np.load(filters_path, allow_pickle=False) as f:
         return torch.from_numpy(f[f"mel_{n_mels}"]).to(device)
 
-def log_mel_spectrogram(audio: Union[str, np.ndarray, torch.Tensor], n_mels: int = 128, padding: int = 0, device: Optional[Union[str, torch.device]] = None):
+def mel_lengths(lengths: torch.Tensor) -> torch.Tensor:
+    # valid frames of each item of a padded batch, the last stft frame is dropped as below
+    return (lengths // HOP_LENGTH).clamp(min=1)
+
+def log_mel_spectrogram(audio: Union[str, np.ndarray, torch.Tensor], n_mels: int = 128, padding: int = 0, device: Optional[Union[str, torch.device]] = None, lengths: Optional[torch.Tensor] = None):
     if not torch.is_tensor(audio):
         if isinstance(audio, str):
             audio = load_audio(audio)
@@ -77,6 +81,13 @@ def log_mel_spectrogram(audio: Union[str, np.ndarray, torch.Tensor], n_mels: int
     mel_spec = filters @ magnitudes
 
     log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    if lengths is None:
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    else:
+        # padded batch: every item is floored against the max of its own valid frames,
+        # so neither the padding nor the other items shift its dynamic range
+        valid = torch.arange(log_spec.size(-1), device=log_spec.device) < mel_lengths(lengths.to(log_spec.device))[:, None]
+        log_max = log_spec.masked_fill(~valid[:, None, :], float('-inf')).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, log_max - 8.0)
     log_spec = (log_spec + 4.0) / 4.0
     return log_spec
\ No newline at end of file
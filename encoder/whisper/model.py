@@ -32,12 +32,12 @@ class Conv1d(nn.Conv1d):
     def _conv_forward(self, x: Tensor, weight: Tensor, bias: Optional[Tensor]) -> Tensor:
         return super()._conv_forward(x, weight.to(x.dtype), None if bias is None else bias.to(x.dtype))
 
-def sinusoids(length, channels, max_timescale=10000):
+def sinusoids(length, channels, max_timescale=10000, device=None):
     assert channels % 2 == 0
     log_timescale_increment = np.log(max_timescale) / (channels // 2 - 1)
     inv_timescales = torch.exp(-log_timescale_increment * torch.arange(channels // 2))
     scaled_time = torch.arange(length)[:, np.newaxis] * inv_timescales[np.newaxis, :]
-    return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1).to(device="cuda")
+    return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1).to(device=device)
 
 class MultiHeadAttention(nn.Module):
     def __init__(self, n_state: int, n_head: int):
@@ -76,7 +76,7 @@ class MultiHeadAttention(nn.Module):
 
         qk = q @ k
         if mask is not None:
-            qk = qk + mask[:n_ctx, :n_ctx]
+            qk = qk + (mask[:n_ctx, :n_ctx] if mask.dim() == 2 else mask)
         qk = qk.float()
 
         w = F.softmax(qk, dim=-1).to(q.dtype)
@@ -118,18 +118,28 @@ class AudioEncoder(nn.Module):
         self.ln_post = LayerNorm(n_state)
         self.n_audio_state = n_state
 
-    def forward(self, x: Tensor):
+    def forward(self, x: Tensor, lengths: Optional[Tensor] = None):
+        # lengths: valid mel frames of each item of a padded batch, their padding is masked out of attention
         x = F.gelu(self.conv1(x))
         x = F.gelu(self.conv2(x))
         x = x.permute(0, 2, 1)
-        x = (x + sinusoids(x.size(1), self.n_audio_state)).to(x.dtype)
+        x = (x + sinusoids(x.size(1), self.n_audio_state, device=x.device)).to(x.dtype)
 
+        mask = None
+        if lengths is not None:
+            valid = torch.arange(x.size(1), device=x.device) < self.output_lengths(lengths.to(x.device))[:, None]
+            mask = torch.zeros(valid.shape, device=x.device).masked_fill(~valid, float('-inf'))[:, None, None, :]
         for block in self.blocks:
-            x = block(x)
+            x = block(x, mask=mask)
 
         x = self.ln_post(x)
         return x
 
+    @staticmethod
+    def output_lengths(lengths: Tensor) -> Tensor:
+        # conv2 halves the frame rate
+        return (lengths + 1) // 2
+
 class Whisper(nn.Module):
     def __init__(self, dims: ModelDimensions):
         super().__init__()
@@ -0,0 +1,46 @@
+import math
+import types
+import torch
+from diffusion.unit2mel import Unit2Mel
+from tools.infer_tools import DiffusionSVC
+
+class ConvVocoder:
+    # only what check_precision / check_int8 touch on the real Vocoder
+    def __init__(self, out_dims):
+        self.vocoder = types.SimpleNamespace(autocast_dtype=None, decoder_model=torch.nn.Sequential(torch.nn.Conv1d(out_dims, 4, 3, padding=1)))
+
+    def infer(self, mel, f0=None):
+        return self.vocoder.decoder_model(mel.transpose(1, 2)).flatten(1)[:, None, :]
+
+def small_svc():
+    svc = DiffusionSVC(device='cpu')
+    svc.model = Unit2Mel(12, 2, out_dims=4, n_layers=1, block_out_channels=(16, 32), n_heads=2, n_hidden=8).eval()
+    svc.vocoder = ConvVocoder(4)
+    return svc
+
+@torch.no_grad()
+def test_check_precision_runs_against_fp32():
+    torch.manual_seed(0)
+    svc = small_svc()
+    units = torch.randn(1, 32, 12)
+
+    # same seed and precision on both sides: the comparison itself adds no error
+    errors = svc.check_precision(units, None, None, precision='fp32', spk_id=2, infer_speedup=100, method='dpm-solver')
+    assert set(errors) == {'latent_max_abs_err', 'latent_rel_err', 'wav_max_abs_err', 'wav_rel_err'}
+    assert all(v == 0 for v in errors.values())
+
+    errors = svc.check_precision(units, None, None, precision='bf16', spk_id=2, infer_speedup=100, method='dpm-solver')
+    assert all(math.isfinite(v) for v in errors.values())
+    assert svc.model.decoder.autocast_dtype is None
+
+@torch.no_grad()
+def test_check_int8_quantizes_unet_and_vocoder():
+    torch.manual_seed(0)
+    svc = small_svc()
+    model, generator = svc.model, svc.vocoder.vocoder.decoder_model
+    units = torch.randn(1, 32, 12)
+    errors = svc.check_int8(units, None, None, spk_id=2, infer_speedup=100, method='dpm-solver', convs=True)
+    assert all(math.isfinite(v) for v in errors.values())
+    assert errors['latent_rel_err'] > 0
+    # the fp32 modules are back in place afterwards
+    assert svc.model is model and svc.vocoder.vocoder.decoder_model is generator
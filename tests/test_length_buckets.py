@@ -0,0 +1,18 @@
+import torch
+from diffusion.unit2mel import Unit2Mel
+from tools.sampler_benchmark import bucket_error
+
+@torch.no_grad()
+def test_bucket_padding_is_measured():
+    torch.manual_seed(0)
+    diffusion = Unit2Mel(12, 1, out_dims=4, n_layers=1, block_out_channels=(16, 32), n_heads=2, n_hidden=8).eval().decoder
+    cond = torch.randn(1, 40, 8)
+
+    # an exact fit pads nothing and matches the unpadded path
+    errors = bucket_error(diffusion, cond, 'dpm-solver', 100, 0, [40])
+    assert errors['bucket'] == 40 and errors['bucket_latent_max_abs_err'] == 0
+
+    # the zero tail shifts the GroupNorm statistics of the valid frames too
+    errors = bucket_error(diffusion, cond, 'dpm-solver', 100, 0, [64])
+    assert errors['bucket'] == 64 and errors['bucket_latent_max_abs_err'] > 0
+    assert diffusion.length_buckets is None
@@ -0,0 +1,68 @@
+import torch
+from diffusion.unet1d.unet_1d_condition import UNet1DConditionModel
+from diffusion.pruning import child_block_out_channels, channel_dims, slice_state_dict
+
+N_HEADS = 2
+NORM_GROUPS = 8
+
+def small_unet(block_out_channels):
+    # same layout as Unit2Mel builds it, just narrow
+    return UNet1DConditionModel(
+        in_channels=4 + 8,
+        out_channels=4,
+        block_out_channels=block_out_channels,
+        norm_num_groups=NORM_GROUPS,
+        cross_attention_dim=block_out_channels,
+        attention_head_dim=N_HEADS,
+        only_cross_attention=True,
+        layers_per_block=2,
+        resnet_time_scale_shift='scale_shift').eval()
+
+def group_permutation(width, generator):
+    # shuffles channels only inside their norm group (and so inside their attention head),
+    # which leaves the function of the network unchanged when applied consistently
+    group = width // NORM_GROUPS
+    return torch.cat([g * group + torch.randperm(group, generator=generator) for g in range(NORM_GROUPS)])
+
+@torch.no_grad()
+def test_permuted_child_matches_parent():
+    # equal widths on two levels: applying the wrong level's index set would go unnoticed by shapes
+    block_out_channels = [16, 32, 32, 48]
+    generator = torch.Generator().manual_seed(0)
+    parent = small_unet(block_out_channels)
+    child = small_unet(block_out_channels)
+    index_sets = [group_permutation(c, generator) for c in block_out_channels]
+    dims = channel_dims(parent)
+    child.load_state_dict(slice_state_dict(parent.state_dict(), child.state_dict(), dims, block_out_channels, index_sets))
+
+    x = torch.randn(2, 12, 64, generator=generator)
+    t = torch.tensor([10, 500])
+    assert torch.allclose(child(x, t).sample, parent(x, t).sample, atol=1e-5)
+
+@torch.no_grad()
+def test_pruned_child_takes_kept_channels():
+    block_out_channels = [16, 32, 32, 48]
+    child_channels = child_block_out_channels(block_out_channels, 0.5, N_HEADS)
+    generator = torch.Generator().manual_seed(0)
+    parent = small_unet(block_out_channels)
+    child = small_unet(child_channels)
+    index_sets = [torch.randperm(c, generator=generator)[:w].sort().values for c, w in zip(block_out_channels, child_channels)]
+    parent_state, child_state = parent.state_dict(), child.state_dict()
+    sliced = slice_state_dict(parent_state, child_state, channel_dims(parent), block_out_channels, index_sets)
+
+    # every tensor is copied from the parent, none is left at random init
+    assert all(sliced[key] is not child_state[key] for key in child_state)
+    child.load_state_dict(sliced)
+
+    # the first resnet of the second level reads the kept channels of the first level
+    weight = parent_state['down_blocks.1.resnets.0.conv1.weight']
+    assert torch.equal(sliced['down_blocks.1.resnets.0.conv1.weight'], weight[index_sets[1]][:, index_sets[0]])
+
+    # the last resnet of the first up block reads the mid output and the level 2 skip
+    weight = parent_state['up_blocks.0.resnets.2.conv1.weight']
+    kept = torch.cat([index_sets[3], block_out_channels[3] + index_sets[2]])
+    assert torch.equal(sliced['up_blocks.0.resnets.2.conv1.weight'], weight[index_sets[3]][:, kept])
+
+    # the stem output is the parent's on the kept channels
+    x = torch.randn(2, 12, 64, generator=generator)
+    assert torch.allclose(child.conv_in(x), parent.conv_in(x)[:, index_sets[0]], atol=1e-6)
@@ -6,6 +6,7 @@ from cluster import get_cluster_model
 from ..utils import get_topk_acc
 from tools.tools import clip_grad_value_
 from tools.tools import get_encdoer_out_channels
+from tools.async_validation import watch_checkpoints, worker_device, start_worker, finish_worker
 from vector_quantize_pytorch import VectorQuantize
 from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn, MofNCompleteColumn
 
@@ -70,20 +71,13 @@ def test(args, model, loader_test, diffusion_model, saver, semantic_embedding, a
     progress.remove_task(test_task)
     return test_loss, topk_acc
 
-def train(args, initial_global_step, model, optimizer, scheduler, diffusion_model, loader_train, loader_valid, accelerator):
-    if accelerator.is_main_process:
-        saver = Saver(args, initial_global_step=initial_global_step)
-    else:
-        saver = Saver_empty(args, initial_global_step=initial_global_step)
-    
-    clip_grad_norm = float(args['text2semantic']['train']['clip_grad_norm']) if args['text2semantic']['train']['clip_grad_norm'] != -1 else None
-
+def get_semantic_embedding(args, device):
     if args['text2semantic']['train']['units_quantize_type'] == "kmeans":
         codebook = get_cluster_model(args['text2semantic']['model']['codebook_path'])
         codebook = codebook.__dict__["cluster_centers_"]
         semantic_embedding = torch.nn.Embedding(codebook.shape[0], codebook.shape[1], _freeze=True)
         semantic_embedding.weight.data = torch.from_numpy(codebook)
-        semantic_embedding.to(accelerator.device)
+        semantic_embedding.to(device)
 
     elif args['text2semantic']['train']['units_quantize_type'] == "vq":
         semantic_embedding = VectorQuantize(
@@ -97,63 +91,109 @@ def train(args, initial_global_step, model, optimizer, scheduler, diffusion_mode
             )
         model_para = torch.load(args['text2semantic']['model']['codebook_path'])
         semantic_embedding.load_state_dict(model_para["model"])
-        semantic_embedding = semantic_embedding.to(accelerator.device)
+        semantic_embedding = semantic_embedding.to(device)
     else:
         raise ValueError('[x] Unknown quantize_type: ' + args['text2semantic']['train']['units_quantize_type'])
+    return semantic_embedding
+
+def validation_worker(args, initial_global_step, diffusion_model_path, device, poll_interval=30):
+    # runs in its own process: evaluates the checkpoints the trainer saves and logs them under their step
+    from tools.utils import DotDict
+    from tools.infer_tools import DiffusionSVC
+    from text2semantic.utils import get_data_loaders, get_language_model
+    args = DotDict(args)
+    args['text2semantic']['train']['cache_all_data'] = False
+    model = get_language_model(**args).to(device)
+    _, loader_valid = get_data_loaders(args, model=model)
+    diffusion_model = None
+    if diffusion_model_path is not None:
+        diffusion_model = DiffusionSVC(device=device)
+        diffusion_model.load_model(model_path=diffusion_model_path)
+    semantic_embedding = get_semantic_embedding(args, device)
+    saver = Saver(args, initial_global_step=initial_global_step)
+
+    def evaluate(step, path):
+        model.load_state_dict(torch.load(path, map_location=torch.device(device))['model'])
+        saver.global_step = step
+        test_loss, topk_acc = test(args, model, loader_valid, diffusion_model, saver, semantic_embedding, worker_device(device))
+        saver.log_value({'val/loss': test_loss})
+        saver.log_value({'val/top_acc@5': topk_acc})
+
+    watch_checkpoints(args['text2semantic']['train']['expdir'], evaluate, start_step=initial_global_step, poll_interval=poll_interval)
+
+def train(args, initial_global_step, model, optimizer, scheduler, diffusion_model, loader_train, loader_valid, accelerator, diffusion_model_path=None):
+    if accelerator.is_main_process:
+        saver = Saver(args, initial_global_step=initial_global_step)
+    else:
+        saver = Saver_empty(args, initial_global_step=initial_global_step)
+    
+    clip_grad_norm = float(args['text2semantic']['train']['clip_grad_norm']) if args['text2semantic']['train']['clip_grad_norm'] != -1 else None
+
+    semantic_embedding = get_semantic_embedding(args, accelerator.device)
+    async_val = args['text2semantic']['train'].get('async_val', False)
+    worker = None
+    if async_val and accelerator.is_main_process:
+        worker = start_worker(args['text2semantic']['train']['expdir'], validation_worker, dict(args), initial_global_step, diffusion_model_path, args['text2semantic']['train'].get('val_device', 'cpu'), args['text2semantic']['train'].get('val_poll_interval', 30))
 
     # run
     num_batches = len(loader_train)
     start_epoch = initial_global_step // num_batches
     model.train()
-    with progress:
-        train_task = progress.add_task("Train", total=num_batches - 1)
-        for epoch in range(start_epoch, args['text2semantic']['train']['epochs']):
-            for _, data in enumerate(loader_train):
-                with accelerator.accumulate(model):
-                    if accelerator.sync_gradients:
-                        saver.global_step_increment()
-
-                    optimizer.zero_grad()
-
-                    for k in data.keys():
-                        if type(data[k]) is torch.Tensor:
-                            data[k] = data[k].to(accelerator.device)
-                            if k == "phone":
-                                data[k][data[k] == -100] = accelerator.unwrap_model(model).PAD
-                            if k == "tone" and data[k] is not None:
-                                data[k][data[k] == -100] = accelerator.unwrap_model(model).num_tones
-                            if k == "semantic":
-                                data[k][data[k] == -100] = accelerator.unwrap_model(model).semantic_pad_token_id
-
-                    loss = model(**data).loss
-                    grad_norm = clip_grad_value_(model.parameters(), clip_grad_norm)
-
-                    loss += grad_norm
-
-                    if torch.isnan(loss):
-                        raise ValueError('[x] nan loss ')
-                    else:
-                        accelerator.backward(loss)
-                        optimizer.step()
-                        scheduler.step()
-                if accelerator.is_main_process:
-                    current_lr = optimizer.param_groups[0]['lr']
-                    progress.update(train_task, advance=1, description=f"epoch={epoch}, step={saver.global_step}, lr={current_lr:.7f}, loss={loss.item():.4f}, grad_norm={grad_norm:.4f}")
-
-                if accelerator.is_main_process and saver.global_step % args['text2semantic']['train']['interval_log'] == 0:
-                    saver.log_value({'train/loss': loss.item()})
-                    saver.log_value({'train/lr': current_lr})
-
-                if accelerator.is_main_process and saver.global_step % args['text2semantic']['train']['interval_val'] == 0:
-                    unwrap_model = accelerator.unwrap_model(model)
-
-                    saver.save_model(unwrap_model, optimizer, postfix=f'{saver.global_step}')
-
-                    test_loss, topk_acc = test(args, unwrap_model, loader_valid, diffusion_model, saver, semantic_embedding, accelerator)
-
-                    saver.log_value({'val/loss': test_loss})
-                    saver.log_value({'val/top_acc@5': topk_acc})
-
-                    model.train()
-                accelerator.wait_for_everyone()
-            progress.reset(train_task)
\ No newline at end of file
+    try:
+        with progress:
+            train_task = progress.add_task("Train", total=num_batches - 1)
+            for epoch in range(start_epoch, args['text2semantic']['train']['epochs']):
+                for _, data in enumerate(loader_train):
+                    with accelerator.accumulate(model):
+                        if accelerator.sync_gradients:
+                            saver.global_step_increment()
+
+                        optimizer.zero_grad()
+
+                        for k in data.keys():
+                            if type(data[k]) is torch.Tensor:
+                                data[k] = data[k].to(accelerator.device)
+                                if k == "phone":
+                                    data[k][data[k] == -100] = accelerator.unwrap_model(model).PAD
+                                if k == "tone" and data[k] is not None:
+                                    data[k][data[k] == -100] = accelerator.unwrap_model(model).num_tones
+                                if k == "semantic":
+                                    data[k][data[k] == -100] = accelerator.unwrap_model(model).semantic_pad_token_id
+
+                        loss = model(**data).loss
+                        grad_norm = clip_grad_value_(model.parameters(), clip_grad_norm)
+
+                        loss += grad_norm
+
+                        if torch.isnan(loss):
+                            raise ValueError('[x] nan loss ')
+                        else:
+                            accelerator.backward(loss)
+                            optimizer.step()
+                            scheduler.step()
+                    if accelerator.is_main_process:
+                        current_lr = optimizer.param_groups[0]['lr']
+                        progress.update(train_task, advance=1, description=f"epoch={epoch}, step={saver.global_step}, lr={current_lr:.7f}, loss={loss.item():.4f}, grad_norm={grad_norm:.4f}")
+
+                    if accelerator.is_main_process and saver.global_step % args['text2semantic']['train']['interval_log'] == 0:
+                        saver.log_value({'train/loss': loss.item()})
+                        saver.log_value({'train/lr': current_lr})
+
+                    if accelerator.is_main_process and saver.global_step % args['text2semantic']['train']['interval_val'] == 0:
+                        unwrap_model = accelerator.unwrap_model(model)
+
+                        saver.save_model(unwrap_model, optimizer, postfix=f'{saver.global_step}')
+
+                        # with async_val the worker picks the checkpoint up and logs for this step
+                        if not async_val:
+                            test_loss, topk_acc = test(args, unwrap_model, loader_valid, diffusion_model, saver, semantic_embedding, accelerator)
+
+                            saver.log_value({'val/loss': test_loss})
+                            saver.log_value({'val/top_acc@5': topk_acc})
+
+                        model.train()
+                    accelerator.wait_for_everyone()
+                progress.reset(train_task)
+    finally:
+        if worker is not None:
+            finish_worker(args['text2semantic']['train']['expdir'], worker)
\ No newline at end of file
@@ -0,0 +1,67 @@
+import os
+import re
+import time
+import types
+import torch.multiprocessing as mp
+
+def list_checkpoints(expdir, name='model'):
+    # [(step, path)] of the numbered checkpoints in expdir, oldest first
+    pattern = re.compile(rf'{re.escape(name)}_(\d+)\.pt$')
+    checkpoints = []
+    for file in os.listdir(expdir) if os.path.isdir(expdir) else []:
+        match = pattern.match(file)
+        if match is not None:
+            checkpoints.append((int(match.group(1)), os.path.join(expdir, file)))
+    return sorted(checkpoints)
+
+def done_path(expdir):
+    return os.path.join(expdir, 'train_done')
+
+def watch_checkpoints(expdir, evaluate, start_step=0, poll_interval=30, max_retries=3):
+    # evaluates the newest checkpoint whenever one newer than the last evaluated appears; when the
+    # trainer saves faster than validation runs the intermediate ones are skipped instead of queued.
+    # returns once the trainer has marked the run done and the last checkpoint is evaluated
+    last_step = start_step
+    failures = {}
+    while True:
+        # read before listing, so every checkpoint saved before the mark is seen
+        done = os.path.exists(done_path(expdir))
+        checkpoints = [c for c in list_checkpoints(expdir) if c[0] > last_step]
+        if len(checkpoints) == 0:
+            if done:
+                return
+        else:
+            step, path = checkpoints[-1]
+            try:
+                evaluate(step, path)
+                last_step = step
+            except (RuntimeError, EOFError, FileNotFoundError) as e:
+                # still being written or already rotated away by the trainer, a corrupt file fails every time
+                failures[step] = failures.get(step, 0) + 1
+                if failures[step] < max_retries:
+                    print(f' [!] validation of {path} failed, retrying: {e}')
+                else:
+                    print(f' [!] validation of {path} failed {max_retries} times, skipping it: {e}')
+                    last_step = step
+        if not done:
+            time.sleep(poll_interval)
+
+def worker_device(device):
+    # test() only reads accelerator.device, the worker runs outside the accelerate launch
+    return types.SimpleNamespace(device=device, is_main_process=True)
+
+def start_worker(expdir, target, *args):
+    # spawn: the trainer already holds cuda state, which a forked child could not use
+    if os.path.exists(done_path(expdir)):
+        os.remove(done_path(expdir))
+    process = mp.get_context('spawn').Process(target=target, args=args, daemon=True)
+    process.start()
+    print(f' [*] Validation worker started (pid {process.pid})')
+    return process
+
+def finish_worker(expdir, process):
+    # marks the run done and waits for the worker to validate the checkpoints still pending
+    os.makedirs(expdir, exist_ok=True)
+    open(done_path(expdir), 'w').close()
+    print(' [*] Waiting for the validation worker to finish')
+    process.join()
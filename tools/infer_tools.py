@@ -1,10 +1,15 @@
+import os
+import copy
 import numpy as np
 import torch
 import torch.nn.functional
 from tqdm import tqdm
 from diffusion.unit2mel import load_model_vocoder
 from tools.slicer import split
-from tools.tools import Volume_Extractor, Units_Encoder, cross_fade
+from tools.tools import Volume_Extractor, Units_Encoder, cross_fade, get_autocast_dtype, output_error
+from tools.quantization import quantize_int8
+from tools.onnx_tools import OnnxDenoiser, OnnxGenerator
+from diffusion.lora_adapter import LoraAdapterBank
 
 class DiffusionSVC:
     def __init__(self, device=None):
@@ -24,16 +29,35 @@ class DiffusionSVC:
         self.naive_model = None
         self.naive_model_args = None
         self.use_combo_model = False
+        self.lora_bank = None
 
-    def load_model(self, model_path):
+    def load_model(self, model_path, precision=None, int8=None, int8_convs=None, backend=None, tune_attention=None):
         self.model_path = model_path
-        self.model, self.vocoder, self.args = load_model_vocoder(model_path, device=self.device)
+        self.model, self.vocoder, self.args = load_model_vocoder(model_path, device=self.device, precision=precision, int8=int8, int8_convs=int8_convs, tune_attention=tune_attention)
+        self.use_combo_model = self.model.naive_decoder is not None
+        self.lora_bank = None
+        if int8 is None:
+            int8 = self.args['common']['infer'].get('int8', False)
+        if backend is None:
+            backend = self.args['common']['infer'].get('backend', 'torch')
+        if backend == 'onnx':
+            # the sampler loop stays in torch, the UNet and the vocoder generator run in onnxruntime
+            onnx_dir = os.path.join(os.path.split(model_path)[0], 'onnx')
+            num_threads = self.args['common']['infer'].get('onnx_threads', 0)
+            self.model.decoder.set_length_buckets(None)
+            self.model.decoder.set_deep_cache(None)
+            self.model.decoder.denoise_fn = OnnxDenoiser(os.path.join(onnx_dir, 'denoiser.onnx'), device=self.device, num_threads=num_threads)
+            self.vocoder.vocoder.decoder_model = OnnxGenerator(os.path.join(onnx_dir, 'generator.onnx'), device=self.device, num_threads=num_threads)
+        elif backend != 'torch':
+            raise ValueError(f' [x] Unknown backend: {backend}')
+        self.vocoder.warmup()
 
         self.units_encoder = Units_Encoder(
             self.args['data']['encoder'],
             self.args['data']['encoder_sample_rate'],
             self.args['data']['encoder_hop_size'],
             device=self.device,
+            int8=int8,
         )
 
         self.volume_extractor = Volume_Extractor(
@@ -42,11 +66,68 @@ class DiffusionSVC:
             model_sampling_rate=self.args['data']['sampling_rate']
         )
 
+    def load_adapter(self, name, path):
+        # LoRA speaker adapter trained with 20_train_diffusion.py -l, activated by use_adapter
+        if self.lora_bank is None:
+            self.lora_bank = LoraAdapterBank(self.model, capacity=self.args['common']['infer'].get('lora_cache_size', 8))
+        self.lora_bank.add(name, path)
+
+    def use_adapter(self, name=None):
+        # merges the adapter into the weights, None restores the base model.
+        # this changes the shared weights, so requests with different adapters must not overlap
+        if self.lora_bank is None:
+            if name is None:
+                return
+            raise ValueError(f' [x] Unknown adapter: {name}')
+        self.lora_bank.activate(name)
+
+    def set_precision(self, precision):
+        autocast_dtype = get_autocast_dtype(precision, self.device)
+        self.model.decoder.autocast_dtype = autocast_dtype
+        self.vocoder.vocoder.autocast_dtype = autocast_dtype
+
+    def _seeded_mel_and_wav(self, units, f0, volume, spk_id, aug_shift, infer_speedup, method, seed):
+        torch.manual_seed(seed)
+        mel = self.__call__(units, f0, volume, spk_id=spk_id, aug_shift=aug_shift, infer_speedup=infer_speedup, method=method, use_tqdm=False)
+        return mel, self.vocoder.infer(mel)
+
+    @torch.no_grad()  # 同一输入分别以fp32和低精度推理, 返回latent和波形的误差
+    def check_precision(self, units, f0, volume, precision='fp16', spk_id=1, aug_shift=0, infer_speedup=10, method='unipc', seed=0):
+        restore = self.model.decoder.autocast_dtype, self.vocoder.vocoder.autocast_dtype
+        outputs = []
+        for p in ('fp32', precision):
+            self.set_precision(p)
+            outputs.append(self._seeded_mel_and_wav(units, f0, volume, spk_id, aug_shift, infer_speedup, method, seed))
+        self.model.decoder.autocast_dtype, self.vocoder.vocoder.autocast_dtype = restore
+        (mel_ref, wav_ref), (mel, wav) = outputs
+        return {**output_error(mel_ref, mel, 'latent_'), **output_error(wav_ref, wav, 'wav_')}
+
+    @torch.no_grad()  # 需以fp32加载在cpu上, 与int8量化后的副本对比latent和波形的误差
+    def check_int8(self, units, f0, volume, spk_id=1, aug_shift=0, infer_speedup=10, method='unipc', seed=0, convs=None):
+        if convs is None:
+            convs = self.args['common']['infer'].get('int8_convs', False)
+        mel_ref, wav_ref = self._seeded_mel_and_wav(units, f0, volume, spk_id, aug_shift, infer_speedup, method, seed)
+        model, generator = self.model, self.vocoder.vocoder.decoder_model
+        self.model = quantize_int8(copy.deepcopy(model), convs=convs)
+        if convs:
+            # without convs the vocoder generator has nothing to quantize and the waveform error is the latent's alone
+            self.vocoder.vocoder.decoder_model = quantize_int8(copy.deepcopy(generator), convs=True)
+        try:
+            mel, wav = self._seeded_mel_and_wav(units, f0, volume, spk_id, aug_shift, infer_speedup, method, seed)
+        finally:
+            self.model, self.vocoder.vocoder.decoder_model = model, generator
+        return {**output_error(mel_ref, mel, 'latent_'), **output_error(wav_ref, wav, 'wav_')}
+
     @torch.no_grad()
     def encode_units(self, audio, sr=44100, padding_mask=None):
         assert self.units_encoder is not None
-        hop_size = self.args['data']['block_size'] * sr / self.args['data']['sampling_rate']
-        return self.units_encoder.encode(audio, sr, hop_size, padding_mask=padding_mask)
+        return self.units_encoder.encode(audio, sr, padding_mask=padding_mask)
+
+    @torch.no_grad()
+    def encode_units_batch(self, audio, lengths, sr=44100):
+        # padded batch [B, S] and valid samples of each item -> units [B, T, C] and valid units of each item
+        assert self.units_encoder is not None
+        return self.units_encoder.encode_batch(audio, lengths, sr)
 
     @torch.no_grad()
     def extract_volume_and_mask(self, audio, sr=44100, threhold=-60.0):
@@ -67,21 +148,60 @@ class DiffusionSVC:
             return torch.nn.functional.pad(out_wav, (start_frame * self.vocoder.vocoder_hop_size, 0))
 
     @torch.no_grad()  # 最基本推理代码,将输入标准化为tensor,只与mel打交道
-    def __call__(self, units, f0, volume, spk_id=1, aug_shift=0, gt_spec=None, infer_speedup=10, method='unipc', use_tqdm=True):
+    def __call__(self, units, f0, volume, spk_id=1, aug_shift=0, gt_spec=None, infer_speedup=10, method='unipc', use_tqdm=True, chunk_size=None, chunk_overlap=64, k_step=None, instrument=None, atol=0.0078, rtol=0.05):
         aug_shift = torch.from_numpy(np.array([[float(aug_shift)]])).float().to(self.device)
         spk_id = torch.LongTensor(np.array([[int(spk_id)]])).to(self.device)
 
-        return self.model(units, f0, volume, spk_id=spk_id, aug_shift=aug_shift, gt_spec=gt_spec, infer=True, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm)
+        # f0 only reaches the vocoder, Unit2Mel is conditioned on units and volume
+        return self.model(units, volume=volume, spk_id=spk_id, aug_shift=aug_shift, gt_spec=gt_spec, infer=True, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm, chunk_size=chunk_size, chunk_overlap=chunk_overlap, k_step=k_step, instrument=instrument, atol=atol, rtol=rtol)
 
     @torch.no_grad()  # 比__call__多了声码器代码，输出波形
-    def infer(self, units, f0, volume, gt_spec=None, spk_id=1, aug_shift=0, infer_speedup=10, method='unipc', use_tqdm=True):
+    def infer(self, units, f0, volume, gt_spec=None, spk_id=1, aug_shift=0, infer_speedup=10, method='unipc', use_tqdm=True, chunk_size=None, chunk_overlap=64, k_step=None, instrument=None, atol=0.0078, rtol=0.05):
+        if k_step is not None and not self.use_combo_model:
+            raise ValueError(' [x] Shallow diffusion (k_step) needs a model trained with a naive decoder (diffusion.model.naive_n_layers > 0)')
         gt_spec = None
-        out_mel = self.__call__(units, f0, volume, spk_id=spk_id, aug_shift=aug_shift, gt_spec=gt_spec, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm)
+        out_mel = self.__call__(units, f0, volume, spk_id=spk_id, aug_shift=aug_shift, gt_spec=gt_spec, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm, chunk_size=chunk_size, chunk_overlap=chunk_overlap, k_step=k_step, instrument=instrument, atol=atol, rtol=rtol)
 
         return self.mel2wav(out_mel, f0)
 
+    @torch.no_grad()  # 同一段输入一次转换为多个说话人, 输出 [N, 1, T] 波形, 顺序同spk_ids
+    def infer_speakers(self, units, volume, spk_ids, aug_shift=0, infer_speedup=10, method='unipc', use_tqdm=True, chunk_size=None, chunk_overlap=64, k_step=None, instrument=None, atol=0.0078, rtol=0.05):
+        if k_step is not None and not self.use_combo_model:
+            raise ValueError(' [x] Shallow diffusion (k_step) needs a model trained with a naive decoder (diffusion.model.naive_n_layers > 0)')
+        aug_shift = torch.from_numpy(np.array([[float(aug_shift)]])).float().to(self.device)
+        spk_ids = torch.LongTensor(np.array(spk_ids, dtype=np.int64).reshape(-1)).to(self.device)
+        out_mel = self.model.infer_speakers(units, volume, spk_ids, aug_shift=aug_shift, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm, chunk_size=chunk_size, chunk_overlap=chunk_overlap, k_step=k_step, instrument=instrument, atol=atol, rtol=rtol)
+        return self.vocoder.infer(out_mel)
+
+    @torch.no_grad()  # 多说话人版本的切片推理, 切片/编码/响度提取只做一次, 返回 [N, T] 的numpy数组
+    def infer_speakers_from_long_audio(self, audio, sr=44100, spk_ids=(1,), aug_shift=0, infer_speedup=10, method='unipc', use_tqdm=True, threhold=-60, threhold_for_split=-40, min_len=5000, chunk_size=None, chunk_overlap=64, k_step=None, instrument=None, atol=0.0078, rtol=0.05):
+        hop_size = self.args['data']['block_size'] * sr / self.args['data']['sampling_rate']
+        segments = split(audio, sr, hop_size, db_thresh=threhold_for_split, min_len=min_len)
+
+        volume, mask = self.extract_volume_and_mask(audio, sr, threhold=float(threhold))
+
+        result = np.zeros((len(spk_ids), 0))
+        current_length = 0
+        for segment in tqdm(segments):
+            start_frame = segment[0]
+            seg_input = torch.from_numpy(segment[1]).float().unsqueeze(0).to(self.device)
+            seg_units = self.units_encoder.encode(seg_input, sr)
+            seg_volume = volume[:, start_frame: start_frame + seg_units.size(1), :]
+            seg_output = self.infer_speakers(seg_units, seg_volume, spk_ids, aug_shift=aug_shift, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm, chunk_size=chunk_size, chunk_overlap=chunk_overlap, k_step=k_step, instrument=instrument, atol=atol, rtol=rtol)
+            _left = start_frame * self.args['data']['block_size']
+            _right = (start_frame + seg_units.size(1)) * self.args['data']['block_size']
+            seg_output = (seg_output.squeeze(1) * mask[:, _left:_right]).cpu().numpy()
+            silent_length = round(start_frame * self.args['data']['block_size']) - current_length
+            if silent_length >= 0:
+                result = np.concatenate((result, np.zeros((len(spk_ids), silent_length)), seg_output), axis=1)
+            else:
+                result = np.stack([cross_fade(r, s, current_length + silent_length) for r, s in zip(result, seg_output)])
+            current_length = current_length + silent_length + seg_output.shape[1]
+
+        return result, self.args['data']['sampling_rate']
+
     @torch.no_grad()  # 切片从音频推理代码
-    def infer_from_long_audio(self, audio, sr=44100, key=0, spk_id=1, aug_shift=0, infer_speedup=10, method='unipc', use_tqdm=True, threhold=-60, threhold_for_split=-40, min_len=5000):
+    def infer_from_long_audio(self, audio, sr=44100, key=0, spk_id=1, aug_shift=0, infer_speedup=10, method='unipc', use_tqdm=True, threhold=-60, threhold_for_split=-40, min_len=5000, chunk_size=None, chunk_overlap=64, k_step=None, instrument=None, atol=0.0078, rtol=0.05):
         hop_size = self.args['data']['block_size'] * sr / self.args['data']['sampling_rate']
         segments = split(audio, sr, hop_size, db_thresh=threhold_for_split, min_len=min_len)
 
@@ -94,14 +214,14 @@ class DiffusionSVC:
         for segment in tqdm(segments):
             start_frame = segment[0]
             seg_input = torch.from_numpy(segment[1]).float().unsqueeze(0).to(self.device)
-            seg_units = self.units_encoder.encode(seg_input, sr, hop_size)
+            seg_units = self.units_encoder.encode(seg_input, sr)
             seg_f0 = f0[:, start_frame: start_frame + seg_units.size(1), :]
             seg_volume = volume[:, start_frame: start_frame + seg_units.size(1), :]
             if gt_spec is not None:
                 seg_gt_spec = gt_spec[:, start_frame: start_frame + seg_units.size(1), :]
             else:
                 seg_gt_spec = None
-            seg_output = self.infer(seg_units, seg_f0, seg_volume, gt_spec=seg_gt_spec, spk_id=spk_id, aug_shift=aug_shift, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm)
+            seg_output = self.infer(seg_units, seg_f0, seg_volume, gt_spec=seg_gt_spec, spk_id=spk_id, aug_shift=aug_shift, infer_speedup=infer_speedup, method=method, use_tqdm=use_tqdm, chunk_size=chunk_size, chunk_overlap=chunk_overlap, k_step=k_step, instrument=instrument, atol=atol, rtol=rtol)
             _left = start_frame * self.args['data']['block_size']
             _right = (start_frame + seg_units.size(1)) * self.args['data']['block_size']
             seg_output *= mask[:, _left:_right]
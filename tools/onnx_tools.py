@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+import torch.nn as nn
+from diffusion.unet1d.unet_1d_condition import UNet1DConditionOutput
+
+class _DenoiserExport(nn.Module):
+    def __init__(self, denoise_fn):
+        super().__init__()
+        self.denoise_fn = denoise_fn
+
+    def forward(self, sample, timestep):
+        return self.denoise_fn(sample, timestep).sample
+
+@torch.no_grad()
+def export_denoiser(denoise_fn, path, in_channels, n_frames=301, opset=17):
+    # n_frames is deliberately not a multiple of the UNet downsampling factor, so the traced
+    # graph takes the forward_upsample_size branch and stays valid for every length.
+    # timestep is float since the dpm-solver / unipc wrappers feed continuous times
+    sample = torch.randn(1, in_channels, n_frames)
+    timestep = torch.full((1,), 500.)
+    torch.onnx.export(
+        _DenoiserExport(denoise_fn).eval().cpu(), (sample, timestep), path,
+        input_names=['sample', 'timestep'], output_names=['noise_pred'],
+        dynamic_axes={'sample': {0: 'batch', 2: 'frames'}, 'timestep': {0: 'batch'}, 'noise_pred': {0: 'batch', 2: 'frames'}},
+        opset_version=opset)
+
+@torch.no_grad()
+def export_generator(generator, path, in_channels, n_frames=64, opset=17):
+    # the istft head ends in torch.polar / torch.istft, which the onnx exporter can not lower
+    from encoder.hifi_vaegan.modules.models import ISTFTGenerator
+    if isinstance(generator, ISTFTGenerator):
+        raise ValueError(f' [x] The istft-vaegan generator can not be exported to onnx (torch.istft / torch.polar have no export at opset {opset}), keep the torch vocoder for it')
+    z = torch.randn(1, in_channels, n_frames)
+    torch.onnx.export(
+        generator.eval().cpu(), (z,), path,
+        input_names=['z'], output_names=['wav'],
+        dynamic_axes={'z': {0: 'batch', 2: 'frames'}, 'wav': {0: 'batch', 2: 'samples'}},
+        opset_version=opset)
+
+def get_onnx_session(path, device='cpu', num_threads=0):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+    providers = ['CPUExecutionProvider']
+    if str(device).startswith('cuda'):
+        providers.insert(0, 'CUDAExecutionProvider')
+    return ort.InferenceSession(path, sess_options=options, providers=providers)
+
+class OnnxDenoiser(nn.Module):
+    # drop-in for GaussianDiffusion.denoise_fn backed by an onnxruntime session
+    def __init__(self, path, device='cpu', num_threads=0):
+        super().__init__()
+        self.session = get_onnx_session(path, device=device, num_threads=num_threads)
+
+    def forward(self, sample, timestep):
+        noise_pred = self.session.run(None, {
+            'sample': sample.detach().float().cpu().numpy(),
+            'timestep': timestep.detach().float().cpu().numpy().reshape(-1)})[0]
+        return UNet1DConditionOutput(sample=torch.from_numpy(noise_pred).to(sample.device))
+
+class OnnxGenerator(nn.Module):
+    # drop-in for Hifi_VAEGAN.decoder_model backed by an onnxruntime session
+    def __init__(self, path, device='cpu', num_threads=0):
+        super().__init__()
+        self.session = get_onnx_session(path, device=device, num_threads=num_threads)
+
+    def forward(self, z):
+        wav = self.session.run(None, {'z': np.ascontiguousarray(z.detach().float().cpu().numpy())})[0]
+        return torch.from_numpy(wav).to(z.device)
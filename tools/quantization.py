@@ -0,0 +1,93 @@
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from diffusion.unet1d.lora import LoRALinearLayer, LoRAConv1dLayer
+
+class Int8Conv1d(nn.Module):
+    # weight-only int8 with per-output-channel scales, dequantized on the fly. this only saves memory:
+    # rebuilding the float weight every call makes it slower than the fp32 conv it replaces
+    def __init__(self, conv):
+        super().__init__()
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+        weight = conv.weight.detach().float()
+        scale = weight.abs().amax(dim=(1, 2), keepdim=True).clamp(min=1e-8) / 127
+        self.register_buffer('weight_int8', torch.round(weight / scale).to(torch.int8))
+        self.register_buffer('scale', scale)
+        if conv.bias is None:
+            self.bias = None
+        else:
+            self.register_buffer('bias', conv.bias.detach().clone())
+
+    def forward(self, x):
+        weight = self.weight_int8.to(x.dtype) * self.scale.to(x.dtype)
+        return F.conv1d(x, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+def dynamic_int8_linear(linear):
+    # int8 weights, activations quantized per batch at runtime (fbgemm / qnnpack, cpu only)
+    weight = linear.weight.detach().float()
+    scale = weight.abs().amax(dim=1).clamp(min=1e-8).double() / 127
+    qweight = torch.quantize_per_channel(weight, scale, torch.zeros_like(scale, dtype=torch.long), 0, torch.qint8)
+    qlinear = torch.ao.nn.quantized.dynamic.Linear(linear.in_features, linear.out_features, bias_=linear.bias is not None, dtype=torch.qint8)
+    qlinear.set_weight_bias(qweight, None if linear.bias is None else linear.bias.detach().float())
+    return qlinear
+
+def quantize_int8(model, convs=False):
+    # Linear -> dynamic int8; Conv1d stays fp32 unless convs (weight-only int8, memory only);
+    # LoRA branches stay in float
+    for name, child in model.named_children():
+        if isinstance(child, (LoRALinearLayer, LoRAConv1dLayer)) or getattr(child, 'lora_layer', None) is not None:
+            continue
+        if isinstance(child, nn.Linear):
+            setattr(model, name, dynamic_int8_linear(child))
+        elif convs and isinstance(child, nn.Conv1d) and child.padding_mode == 'zeros':
+            setattr(model, name, Int8Conv1d(child))
+        else:
+            quantize_int8(child, convs=convs)
+    return model
+
+def int8_cache_path(ckpt_path):
+    root, ext = os.path.splitext(ckpt_path)
+    return root + '_int8' + ext
+
+def source_stamp(path, convs):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'convs': convs}
+
+def read_int8_cache(ckpt_path, source=None, convs=False):
+    # the cached int8 checkpoint if it was quantized from the current fp32 weights, else None.
+    # the cache records size and mtime of `source` (the file the fp32 weights come from, ckpt_path by default)
+    cache_path = int8_cache_path(ckpt_path)
+    if not os.path.exists(cache_path):
+        return None
+    cache = torch.load(cache_path, map_location='cpu')
+    if cache.get('source') != source_stamp(source or ckpt_path, convs):
+        print(' [!] Int8 weights are stale, quantizing again:', cache_path)
+        return None
+    return cache
+
+def load_int8(model, ckpt_path, load_fp32, prepare=None, source=None, convs=False, meta=None, cache=None):
+    # quantizes once and saves the int8 state dict next to the fp32 checkpoint,
+    # later loads only swap the modules and read the cached weights.
+    # prepare(model) runs right before quantization in both cases (e.g. removing weight norm).
+    # meta is saved with the weights and has to match on load, so a model can be built from it
+    # without reading the fp32 checkpoint; pass the cache if read_int8_cache already ran for that
+    if cache is None:
+        cache = read_int8_cache(ckpt_path, source=source, convs=convs)
+    if cache is not None and cache.get('meta') == meta:
+        if prepare is not None:
+            prepare(model)
+        quantize_int8(model, convs=convs)
+        model.load_state_dict(cache['model'])
+        return model
+    load_fp32(model)
+    if prepare is not None:
+        prepare(model)
+    quantize_int8(model, convs=convs)
+    cache_path = int8_cache_path(ckpt_path)
+    torch.save({'source': source_stamp(source or ckpt_path, convs), 'meta': meta, 'model': model.state_dict()}, cache_path)
+    print(' [*] Saved int8 weights to', cache_path)
+    return model
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import threading
+import argparse
+import resource
+import torch
+from tools import utils
+from diffusion.unit2mel import load_model_vocoder, load_svc_model
+from diffusion.diffusion import SamplerTrace
+from tools.tools import output_error
+
+def parse_args(args=None, namespace=None):
+    parser = argparse.ArgumentParser(description='sweep sampler x speedup x length over GaussianDiffusion.forward')
+    parser.add_argument("-m", "--model",    type=str, default=None, help="checkpoint, a randomly initialized Unit2Mel is used when omitted")
+    parser.add_argument("-c", "--config",   type=str, default="configs/config.yaml", help="config for the random model")
+    parser.add_argument("--dims",           type=int, default=64, help="latent dims of the random model")
+    parser.add_argument("-d", "--device",   type=str, default=None)
+    parser.add_argument("--methods",        type=str, nargs='+', default=['dpm-solver', 'unipc', 'pndm', 'ddim'])
+    parser.add_argument("--speedups",       type=int, nargs='+', default=[10, 20, 50, 100])
+    parser.add_argument("--lengths",        type=int, nargs='+', default=[128, 512, 2048], help="frames")
+    parser.add_argument("--repeats",        type=int, default=3)
+    parser.add_argument("--seed",           type=int, default=0)
+    parser.add_argument("--length_buckets", type=int, nargs='+', default=None, help="also report the error of padding to these buckets against the unpadded run")
+    parser.add_argument("-o", "--output",   type=str, default="sampler_benchmark.json")
+    return parser.parse_args(args=args, namespace=namespace)
+
+def load_benchmark_model(model_path, config_path, dims, device):
+    if model_path is not None:
+        model, _, args = load_model_vocoder(model_path, device=device)
+    else:
+        args = utils.load_config(config_path)
+        model = load_svc_model(args=args, vocoder_dimension=dims).to(device).eval()
+    return model, args
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+class RSSPeak:
+    # peak growth of the resident set during the block, polled from a thread. ru_maxrss can not be reset,
+    # so it would report the largest run of the whole process for every later configuration
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stop = threading.Event()
+
+    def poll(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.base = self.peak = rss_bytes()
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+def peak_memory_mb(diffusion, cond, method, infer_speedup, seed):
+    # memory of one run of this configuration: allocator peak on cuda, peak rss growth on linux cpu, None otherwise
+    if cond.device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(cond.device)
+        base = torch.cuda.memory_allocated(cond.device)
+        run_sampler(diffusion, cond, method, infer_speedup, seed)
+        return (torch.cuda.max_memory_allocated(cond.device) - base) / 2 ** 20
+    if not os.path.exists('/proc/self/statm'):
+        return None
+    with RSSPeak() as rss:
+        run_sampler(diffusion, cond, method, infer_speedup, seed)
+    return (rss.peak - rss.base) / 2 ** 20
+
+def bucket_error(diffusion, cond, method, infer_speedup, seed, buckets):
+    # same seed and noise with and without padding to the bucket, eager in both cases so only the
+    # padding differs (attention and GroupNorm statistics both see the zero tail)
+    state = diffusion.length_buckets, diffusion.bucket_denoise_fn, diffusion.bucket_max_batch_size
+    try:
+        diffusion.set_length_buckets(None)
+        x, _ = run_sampler(diffusion, cond, method, infer_speedup, seed)
+        diffusion.set_length_buckets(buckets, compile=False)
+        bucket = diffusion.get_length_bucket(cond.shape[1])
+        x_bucket, _ = run_sampler(diffusion, cond, method, infer_speedup, seed)
+    finally:
+        diffusion.length_buckets, diffusion.bucket_denoise_fn, diffusion.bucket_max_batch_size = state
+    return {'bucket': bucket, **output_error(x, x_bucket, 'bucket_latent_')}
+
+@torch.no_grad()
+def run_sampler(diffusion, cond, method, infer_speedup, seed, instrument=None):
+    torch.manual_seed(seed)
+    synchronize(cond.device)
+    start = time.perf_counter()
+    x = diffusion(cond, infer=True, infer_speedup=infer_speedup, method=method, instrument=instrument)
+    synchronize(cond.device)
+    return x, time.perf_counter() - start
+
+def benchmark(model, args, methods, speedups, lengths, repeats=3, seed=0, length_buckets=None):
+    diffusion = model.decoder
+    device = next(model.parameters()).device
+    n_hidden = args['diffusion']['model']['n_hidden']
+    frame_seconds = args['data']['block_size'] / args['data']['sampling_rate']
+
+    results = []
+    for n_frames in lengths:
+        cond = torch.randn(1, n_frames, n_hidden, device=device, generator=torch.Generator(device).manual_seed(seed))
+        # deterministic full-length ddim from the same initial noise
+        reference, _ = run_sampler(diffusion, cond, 'ddim', 1, seed)
+        for method in methods:
+            for infer_speedup in speedups:
+                # the untimed warmup also counts the denoiser calls, in the sampler itself so compiled
+                # or bucketed denoisers are counted the same; the timed runs stay uninstrumented
+                trace = SamplerTrace()
+                run_sampler(diffusion, cond, method, infer_speedup, seed, instrument=trace)
+                times = []
+                for _ in range(repeats):
+                    x, elapsed = run_sampler(diffusion, cond, method, infer_speedup, seed)
+                    times.append(elapsed)
+                wall_time = sorted(times)[len(times) // 2]
+                result = {
+                    'method': method,
+                    'infer_speedup': infer_speedup,
+                    'n_frames': n_frames,
+                    'wall_time': wall_time,
+                    'rtf': wall_time / (n_frames * frame_seconds),
+                    'nfe': trace.nfe,
+                    'peak_memory_mb': peak_memory_mb(diffusion, cond, method, infer_speedup, seed),
+                    'latent_rmse': (x - reference).pow(2).mean().sqrt().item(),
+                }
+                if length_buckets:
+                    result.update(bucket_error(diffusion, cond, method, infer_speedup, seed, length_buckets))
+                print(result)
+                results.append(result)
+    return results
+
+if __name__ == '__main__':
+    cmd = parse_args()
+    device = cmd.device
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model, args = load_benchmark_model(cmd.model, cmd.config, cmd.dims, device)
+    results = benchmark(model, args, cmd.methods, cmd.speedups, cmd.lengths, repeats=cmd.repeats, seed=cmd.seed, length_buckets=cmd.length_buckets)
+    with open(cmd.output, 'w') as f:
+        json.dump({'model': cmd.model, 'device': str(device), 'results': results}, f, indent=2)
+    print(' [*] Saved benchmark to', cmd.output)
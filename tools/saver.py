@@ -87,7 +87,8 @@ class Saver(object):
             model,
             optimizer,
             name='model',
-            postfix=''):
+            postfix='',
+            state_dict=None):
         # path
         if postfix:
             postfix = '_' + postfix
@@ -96,17 +97,19 @@ class Saver(object):
 
         if type(model) is torch.nn.parallel.distributed.DistributedDataParallel or type(model) is torch.nn.parallel.DistributedDataParallel:
             model = model.module
+        if state_dict is None:
+            state_dict = model.state_dict()
             
         # save
         if optimizer is not None:
             torch.save({
                 'global_step': self.global_step,
-                'model': model.state_dict(),
+                'model': state_dict,
                 'optimizer': optimizer.state_dict()}, path_pt)
         else:
             torch.save({
                 'global_step': self.global_step,
-                'model': model.state_dict()}, path_pt)
+                'model': state_dict}, path_pt)
 
     def delete_model(self, name='model', postfix=''):
         if postfix:
@@ -149,7 +152,8 @@ class Saver_empty(object):
             optimizer,
             name='model',
             postfix='',
-            to_json=False):
+            to_json=False,
+            state_dict=None):
         pass
 
     def delete_model(self, name='model', postfix=''):
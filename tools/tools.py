@@ -6,8 +6,9 @@ from fairseq import checkpoint_utils
 from transformers import AutoFeatureExtractor, Wav2Vec2BertModel
 from torchaudio.transforms import Resample
 from torch.optim.lr_scheduler import StepLR
-from encoder.whisper.audio import log_mel_spectrogram
+from encoder.whisper.audio import log_mel_spectrogram, mel_lengths
 from encoder.whisper.model import ModelDimensions, Whisper
+from tools.quantization import load_int8, read_int8_cache
 
 class Volume_Extractor:
     def __init__(self, hop_size=512, block_size=None, model_sampling_rate=None):
@@ -41,7 +42,7 @@ class Volume_Extractor:
         return mask
 
 class Units_Encoder:
-    def __init__(self, encoder, encoder_sample_rate=16000, encoder_hop_size=320, device=None, units_forced_mode='nearest'):
+    def __init__(self, encoder, encoder_sample_rate=16000, encoder_hop_size=320, device=None, units_forced_mode='nearest', int8=False):
         if device is None:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.device = device
@@ -53,8 +54,10 @@ class Units_Encoder:
         
         is_loaded_encoder = False
         if encoder == 'whisper_large_v3':
-            self.model = WhisperLargeV3(device=device)
+            self.model = WhisperLargeV3(device=device, int8=int8)
             is_loaded_encoder = True
+        elif int8:
+            print(f' [!] int8 is not implemented for {encoder}, running it in fp32')
         if encoder == 'w2v-bert':
             self.model = Wav2Vec2Bert(device=device)
             is_loaded_encoder = True
@@ -73,7 +76,7 @@ class Units_Encoder:
         self.encoder_sample_rate = encoder_sample_rate
         self.encoder_hop_size = encoder_hop_size
 
-    def encode(self, audio, sample_rate, padding_mask=None):
+    def resample(self, audio, sample_rate):
         if self.units_forced_mode not in ('rfa441to512', 'rfa512to441'):
             if sample_rate == self.encoder_sample_rate:
                 audio_res = audio
@@ -89,6 +92,10 @@ class Units_Encoder:
                 _audio = audio.cpu().numpy()    
             audio_res = librosa.resample(_audio, orig_sr=sample_rate, target_sr=self.encoder_sample_rate)
             audio_res = torch.from_numpy(audio_res).to(self.device)
+        return audio_res
+
+    def encode(self, audio, sample_rate, padding_mask=None):
+        audio_res = self.resample(audio, sample_rate)
 
         if self.encoder == 'w2v-bert' and isinstance(audio_res, torch.Tensor):
             audio_res = audio_res.cpu().numpy()
@@ -102,21 +109,46 @@ class Units_Encoder:
 
         return units
 
+    def encode_batch(self, audio, lengths, sample_rate):
+        # audio: [B, S] padded batch (or a list of 1d items), lengths: valid samples of each item at sample_rate.
+        # returns units [B, T, C] and the valid units of each item; padding never reaches the valid part
+        if isinstance(audio, (list, tuple)):
+            audio = torch.nn.utils.rnn.pad_sequence([torch.as_tensor(a, dtype=torch.float32) for a in audio], batch_first=True)
+        audio = torch.as_tensor(audio, dtype=torch.float32, device=self.device)
+        lengths = torch.as_tensor(lengths, device=self.device)
+        audio_res = self.resample(audio, sample_rate)
+        lengths = torch.ceil(lengths * audio_res.size(-1) / audio.size(-1)).long().clamp(max=audio_res.size(-1))
+        if audio_res.size(-1) < 400:
+            audio_res = torch.nn.functional.pad(audio_res, (0, 400 - audio_res.size(-1)))
+        return self.model.encode_batch(audio_res, lengths)
+
 class WhisperLargeV3(torch.nn.Module):
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', int8=False):
         super().__init__()
         self.device = device
         print('whisper_large_v3')
-        checkpoint = torch.load('pretrain/large-v3_encoder.pt', map_location="cpu")
+        ckpt_path = 'pretrain/large-v3_encoder.pt'
+        cache = read_int8_cache(ckpt_path) if int8 else None
+        if cache is not None and cache.get('meta') is not None:
+            # the dims are saved with the int8 weights, the fp32 checkpoint is not read at all
+            checkpoint = {'dims': cache['meta']}
+        else:
+            checkpoint = torch.load(ckpt_path, map_location="cpu")
         dims = ModelDimensions(**checkpoint["dims"])
         model = Whisper(dims)
-        model.load_state_dict(checkpoint["model_state_dict"])
+        if int8:
+            load_int8(model, ckpt_path, lambda m: m.load_state_dict(checkpoint["model_state_dict"]), meta=checkpoint["dims"], cache=cache)
+        else:
+            model.load_state_dict(checkpoint["model_state_dict"])
         self.hidden_dim = dims
         self.model = model.to(device)
         self.model.eval()
 
     @torch.inference_mode()
     def __call__(self, audio, padding_mask=None):
+        if padding_mask is not None:
+            audio = audio.view(-1, padding_mask.size(-1))
+            return self.encode_batch(audio, (~padding_mask.view(audio.shape)).sum(-1))[0]
         audio = audio.view(1,-1)
         mel = log_mel_spectrogram(audio).to(self.device)
         with torch.no_grad():
@@ -124,6 +156,13 @@ class WhisperLargeV3(torch.nn.Module):
                 mel = mel.unsqueeze(0)
             units = self.model.encoder(mel).squeeze().data.cpu().float()
             return units
+
+    @torch.inference_mode()
+    def encode_batch(self, audio, lengths):
+        mel = log_mel_spectrogram(audio, lengths=lengths).to(self.device)
+        frames = mel_lengths(lengths.to(self.device))
+        units = self.model.encoder(mel, lengths=frames).data.cpu().float()
+        return units, self.model.encoder.output_lengths(frames).cpu()
         
 class Wav2Vec2Bert:
     def __init__(self, device='cpu'):
@@ -135,11 +174,24 @@ class Wav2Vec2Bert:
 
     @torch.no_grad()
     def __call__(self, audio, padding_mask=None):  # B, T
+        if padding_mask is not None:
+            audio = torch.as_tensor(audio).view(-1, padding_mask.size(-1))
+            return self.encode_batch(audio, (~padding_mask.view(audio.shape)).sum(-1))[0]
         inputs = self.processor(audio, sampling_rate=16000, return_tensors="pt")
         for k, input in inputs.items():
             inputs[k] = input.to(self.device)
         outputs = self.model(**inputs)
         return outputs.last_hidden_state
+
+    @torch.no_grad()
+    def encode_batch(self, audio, lengths):
+        # the processor pads the trimmed items itself and returns the mask at the model's frame rate
+        items = [a[:int(n)].cpu().numpy() for a, n in zip(audio, lengths)]
+        inputs = self.processor(items, sampling_rate=16000, padding=True, return_attention_mask=True, return_tensors="pt")
+        for k, input in inputs.items():
+            inputs[k] = input.to(self.device)
+        outputs = self.model(**inputs)
+        return outputs.last_hidden_state, inputs['attention_mask'].sum(-1).cpu()
     
 class Audio2xlsr_53_56k():
     def __init__(self, path='pretrain/xlsr_53_56k.pt', device='cpu'):
@@ -152,15 +204,28 @@ class Audio2xlsr_53_56k():
         self.hubert.eval()
 
     def __call__(self, audio, padding_mask=None):
-        with torch.no_grad():
+        if padding_mask is None:
             padding_mask = torch.BoolTensor(audio.shape).fill_(False)
+        return self.extract(audio, padding_mask)[0]
+
+    def encode_batch(self, audio, lengths):
+        padding_mask = torch.arange(audio.size(-1), device=lengths.device)[None, :] >= lengths[:, None]
+        return self.extract(audio, padding_mask)
+
+    def extract(self, audio, padding_mask):
+        # padding_mask is True on padded samples, fairseq returns it downsampled to the units (None if nothing is padded)
+        with torch.no_grad():
             inputs = {
                 "source": audio.to(self.device),
                 "padding_mask": padding_mask.to(self.device)
             }
             logits = self.hubert.extract_features(**inputs)
             units = logits["x"]
-            return units
+            if logits.get("padding_mask") is None:
+                unit_lengths = torch.full((units.size(0),), units.size(1), dtype=torch.long)
+            else:
+                unit_lengths = (~logits["padding_mask"]).sum(-1).cpu()
+            return units, unit_lengths
         
 class StepLRWithWarmUp(StepLR):
     def __init__(self, optimizer, step_size, gamma=0.1, last_epoch=-1, warm_up_steps=1000, start_lr = 1e-6, verbose=False):
@@ -261,4 +326,24 @@ def get_encdoer_out_channels(encoder):
         return 768
     elif encoder == 'xlsr_53_56k':
         return 1024
-    raise ValueError(f"[x] Unknown encoder: {encoder}")
\ No newline at end of file
+    raise ValueError(f"[x] Unknown encoder: {encoder}")
+
+def output_error(ref, out, prefix=''):
+    return {
+        prefix + 'max_abs_err': (out - ref).abs().max().item(),
+        prefix + 'rel_err': ((out - ref).norm() / ref.norm()).item(),
+    }
+
+def get_autocast_dtype(precision, device):
+    # None means plain fp32; cpu autocast only supports bf16
+    if precision is None or precision == 'fp32':
+        return None
+    device_type = torch.device(device).type
+    if precision == 'fp16':
+        if device_type == 'cpu':
+            print(' [!] fp16 is not supported on cpu, using bf16 instead')
+            return torch.bfloat16
+        return torch.float16
+    elif precision == 'bf16':
+        return torch.bfloat16
+    raise ValueError(f"[x] Unknown precision: {precision}")
\ No newline at end of file